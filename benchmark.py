@@ -0,0 +1,289 @@
+"""Benchmark the MarkFunk compiler on synthetic documents.
+
+Generates a document of the requested size and shape, times compile(),
+process_code_block() and each loop helper separately, and prints the results
+as JSON so runs can be compared across versions:
+
+    python benchmark.py --lines 50000 --output before.json
+    python benchmark.py --lines 50000 --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import mfmd
+
+# Effects used by the generator; every one of them has a rule in the default pattern table
+EFFECTS = ['red', 'blue', 'green', 'purple', 'big', 'tiny', 'rainbow', 'glow', 'spin', 'shout',
+           'center', 'alert', 'note', 'spoiler', 'highlight', 'neon', 'wave', 'fire', 'ice', 'cosmic']
+WORDS = ['funky', 'markup', 'text', 'page', 'loop', 'value', 'item', 'style', 'party', 'glow']
+
+
+def generate_effect(rng, depth):
+    """Return an @effect{...} call nested depth levels deep."""
+    text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+    for _ in range(depth):
+        text = f'@{rng.choice(EFFECTS)}{{{text}}}'
+    return text
+
+
+def generate_line(rng, effect_density, nesting):
+    """Return one body line with about effect_density effects on it."""
+    effects = int(effect_density) + (rng.random() < effect_density % 1)
+    words = [rng.choice(WORDS) for _ in range(rng.randint(4, 10))]
+    for _ in range(effects):
+        words.insert(rng.randrange(len(words) + 1), generate_effect(rng, rng.randint(1, max(1, nesting))))
+    text = ' '.join(words)
+    kind = rng.random()
+    if kind < 0.05:
+        return f'## {text}'
+    if kind < 0.25:
+        return f'- {text}'
+    if kind < 0.35:
+        return f'1. **{text}**'
+    if kind < 0.40:
+        return f'| {text} | *{rng.choice(WORDS)}* |'
+    return text
+
+
+def generate_code_block(rng, code_lines, loop_size):
+    """Return the body of a fenced code block using variables and every loop kind."""
+    lines = ['@var{name=MarkFunk}', '@var{color=red}']
+    kinds = [
+        lambda: f'@for{{1-{loop_size}}}:Row {{i}} @{{color}}{{{{name}}}} **{{i}}**',
+        lambda: '@foreach{' + ', '.join(rng.sample(WORDS, 5)) + '}:Item @big{{item}} for {name}',
+        lambda: f'@while{{{loop_size}}}:Step {{i}} of @blink{{{{name}}}}',
+        lambda: f'@repeat{{{loop_size}}}:@rainbow{{{{name}}}} again',
+        lambda: f'Plain line with {{name}} and {generate_effect(rng, 2)}',
+    ]
+    while len(lines) < code_lines:
+        lines.append(rng.choice(kinds)())
+    return '\n'.join(lines[:max(code_lines, 1)])
+
+
+def generate_document(lines=10000, effect_density=1.0, nesting=2, code_every=200, code_lines=10,
+                      loop_size=50, seed=0):
+    """Return a synthetic MarkFunk document and the bodies of its code blocks.
+
+    lines counts body lines; a fenced code block of code_lines lines is added
+    after every code_every of them (0 for none).
+    """
+    rng = random.Random(seed)
+    out = ['# Synthetic MarkFunk benchmark']
+    blocks = []
+    for number in range(1, lines + 1):
+        out.append(generate_line(rng, effect_density, nesting))
+        if code_every and number % code_every == 0:
+            block = generate_code_block(rng, code_lines, loop_size)
+            blocks.append(block)
+            out.extend(['```', block, '```'])
+    return '\n'.join(out), blocks
+
+
+def best_of(repeat, function, *args):
+    """Return the fastest of repeat timed calls, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def uncached_code_blocks(compiler, blocks):
+    for block in blocks:
+        compiler.block_cache.clear()
+        compiler.process_code_block(block)
+
+
+def run(args):
+    document, blocks = generate_document(args.lines, args.effect_density, args.nesting, args.code_every,
+                                         args.code_lines, args.loop_size, args.seed)
+    line_count = document.count('\n') + 1
+    compiler = mfmd.MarkFunkCompiler()
+
+    def compile_cold():
+        compiler.block_cache.clear()
+        compiler.compile(document)
+
+    phases = {'compile': best_of(args.repeat, compile_cold)}
+    if blocks:
+        phases['process_code_block'] = best_of(args.repeat, uncached_code_blocks, compiler, blocks)
+    variables = {'name': 'MarkFunk', 'color': 'red'}
+    items = ', '.join(WORDS)
+    phases['process_for'] = best_of(args.repeat, compiler.process_for, 1, args.loop_size,
+                                    'Row {i} @{color}{{name}} **{i}**', variables)
+    phases['process_foreach'] = best_of(args.repeat, compiler.process_foreach, items,
+                                        'Item @big{{item}} for {name}', variables)
+    phases['process_while'] = best_of(args.repeat, compiler.process_while, args.loop_size,
+                                      'Step {i} of @blink{{name}}', variables)
+    phases['process_repeat'] = best_of(args.repeat, compiler.process_repeat, args.loop_size,
+                                       '@rainbow{{name}} again', variables)
+
+    # Measured in a separate pass: tracing allocations slows everything down
+    tracemalloc.start()
+    compile_cold()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'version': mfmd.__version__,
+        'python': platform.python_version(),
+        'parameters': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+        'document': {'lines': line_count, 'bytes': len(document.encode('utf-8')), 'code_blocks': len(blocks)},
+        'lines_per_second': line_count / phases['compile'] if phases['compile'] else None,
+        'peak_memory_bytes': peak_memory,
+        'phases_seconds': phases,
+    }
+
+
+# Lines that would make a backtracking or rescanning effect parser, or a
+# backtracking link rule, go superlinear
+PATHOLOGICAL = {
+    'unclosed_openers': lambda n: '@red{' * n,
+    'deep_nesting': lambda n: '@red{' * n + 'x' + '}' * n,
+    'unknown_effects': lambda n: '@nope{' * n + '}' * n,
+    'nested_var': lambda n: '@var{' * n + 'a=b' + '}' * n,
+    'unclosed_var': lambda n: '@var{a=' * n + '}',
+    'unmatched_var': lambda n: '@var{' * n + '}' * n,
+    'unclosed_links': lambda n: '[a](' * n,
+    'unclosed_images': lambda n: '![a](' * n,
+    'unclosed_link_text': lambda n: '[a' + '](' * n,
+    'stray_braces': lambda n: '{' * n + '}' * (n // 2),
+    'mixed': lambda n: ''.join(('@big{', '{', 'x', '}', '@center{')[i % 5] for i in range(n)),
+}
+
+
+def pathological(args):
+    """Time apply_patterns() on hostile lines of doubling size.
+
+    A linear parser takes about twice as long each time the input doubles;
+    returns the results and whether any case grew faster than --max-growth.
+    """
+    compiler = mfmd.MarkFunkCompiler()
+    sizes = [args.size << step for step in range(4)]
+    cases = {}
+    linear = True
+    for name, make in PATHOLOGICAL.items():
+        seconds = [best_of(args.repeat, compiler.apply_patterns, make(size)) for size in sizes]
+        growth = max(after / before for before, after in zip(seconds, seconds[1:]) if before)
+        linear = linear and growth <= args.max_growth
+        cases[name] = {'seconds': dict(zip(map(str, sizes), seconds)), 'growth_per_doubling': growth}
+    return {'version': mfmd.__version__, 'python': platform.python_version(), 'cases': cases}, linear
+
+
+# Modules only the CLI needs; importing mfmd as a library must not load them
+CLI_ONLY_MODULES = ['argparse', 'colorama', 'concurrent.futures', 'http.server', 'multiprocessing',
+                    'socket', 'tempfile', 'webbrowser']
+
+STARTUP_PROBE = """
+import sys, time
+started = time.perf_counter()
+import mfmd
+imported = time.perf_counter()
+mfmd.MarkFunkCompiler().compile('# Hello @red{world}')
+compiled = time.perf_counter()
+print(imported - started, compiled - imported, ' '.join(sorted(sys.modules)))
+"""
+
+
+def startup(args):
+    """Measure a cold `import mfmd` and first compile in fresh interpreters.
+
+    Returns the results and whether the import stayed within --import-budget
+    without loading any CLI-only module.
+    """
+    directory = os.path.dirname(os.path.abspath(mfmd.__file__))
+    imports, first_compiles, cumulative = [], [], []
+    for _ in range(args.repeat):
+        probe = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_PROBE], cwd=directory,
+                               capture_output=True, text=True, check=True)
+        import_seconds, compile_seconds, modules = probe.stdout.split(' ', 2)
+        imports.append(float(import_seconds))
+        first_compiles.append(float(compile_seconds))
+        # -X importtime reports "self | cumulative | name" in microseconds
+        for line in probe.stderr.splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) == 3 and fields[2] == 'mfmd':
+                cumulative.append(int(fields[1]) / 1e6)
+    loaded = sorted(set(CLI_ONLY_MODULES) & set(modules.split()))
+    import_ms = min(cumulative or imports) * 1000
+    result = {
+        'version': mfmd.__version__,
+        'python': platform.python_version(),
+        'import_ms': import_ms,
+        'first_compile_ms': min(first_compiles) * 1000,
+        'import_budget_ms': args.import_budget,
+        'cli_modules_loaded': loaded,
+    }
+    return result, import_ms <= args.import_budget and not loaded
+
+
+def compare(result, baseline):
+    """Print how each phase changed relative to a baseline result."""
+    print(f"Compared with {baseline.get('version')} (ratio < 1 is faster):", file=sys.stderr)
+    for phase, seconds in result['phases_seconds'].items():
+        before = baseline.get('phases_seconds', {}).get(phase)
+        if before:
+            print(f'  {phase:20} {before * 1000:9.3f}ms -> {seconds * 1000:9.3f}ms  x{seconds / before:.2f}', file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MarkFunk compiler on a synthetic document")
+    parser.add_argument("--lines", type=int, default=10000, help="Body lines in the document (default: 10000)")
+    parser.add_argument("--effect-density", type=float, default=1.0, help="Average effects per line (default: 1.0)")
+    parser.add_argument("--nesting", type=int, default=2, help="Maximum depth of nested effects (default: 2)")
+    parser.add_argument("--code-every", type=int, default=200, help="Add a code block every N lines, 0 for none (default: 200)")
+    parser.add_argument("--code-lines", type=int, default=10, help="Lines per code block (default: 10)")
+    parser.add_argument("--loop-size", type=int, default=50, help="Iterations of @for/@while/@repeat loops (default: 50)")
+    parser.add_argument("--repeat", type=int, default=3, help="Time each phase this many times and keep the best (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the generator (default: 0)")
+    parser.add_argument("--output", help="Also write the JSON result to this file")
+    parser.add_argument("--compare", help="Previous JSON result to compare against")
+    parser.add_argument("--pathological", action="store_true",
+                        help="Instead, time hostile single lines of doubling size and fail if parsing grows superlinearly")
+    parser.add_argument("--size", type=int, default=5000, help="Pathological mode: smallest line, in tokens (default: 5000)")
+    parser.add_argument("--max-growth", type=float, default=3.0,
+                        help="Pathological mode: fail if time grows more than this when the input doubles (default: 3.0)")
+    parser.add_argument("--startup", action="store_true",
+                        help="Instead, time a cold 'import mfmd' and first compile, and fail if the import is over budget")
+    parser.add_argument("--import-budget", type=float, default=40.0,
+                        help="Startup mode: most milliseconds 'import mfmd' may take (default: 40)")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        result, ok = startup(args)
+        print(json.dumps(result, indent=2))
+        if result['cli_modules_loaded']:
+            print(f"'import mfmd' loaded CLI-only modules: {', '.join(result['cli_modules_loaded'])}", file=sys.stderr)
+        elif not ok:
+            print(f"'import mfmd' took {result['import_ms']:.1f}ms, over the {args.import_budget}ms budget", file=sys.stderr)
+        return 0 if ok else 1
+
+    if args.pathological:
+        result, linear = pathological(args)
+        print(json.dumps(result, indent=2))
+        if not linear:
+            print(f'Superlinear growth: some case took more than {args.max_growth}x as long on twice the input', file=sys.stderr)
+        return 0 if linear else 1
+
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(result, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,137 +1,1111 @@
 import re
+import hashlib
+import io
+import json
+import marshal
+from collections import ChainMap, OrderedDict, deque
+from functools import lru_cache, partial
 from html import escape
-import argparse
+from types import MappingProxyType
 import os
-import webbrowser
-from colorama import init, Fore, Style
+import sys
+import time
+import threading
 
-# Initialize colorama for cross-platform colored output
-init()
+# CLI-only modules (argparse, colorama, http.server, webbrowser, process
+# pools, ...) are imported where they are used, so importing mfmd as a
+# library stays cheap.
+
+class _NoColor:
+    """Stands in for colorama's Fore and Style: every color is an empty string."""
+    def __getattr__(self, name):
+        return ''
+
+Fore = Style = _NoColor()
+
+def use_colors():
+    """Color CLI messages with colorama, when it is installed."""
+    global Fore, Style
+    try:
+        import colorama
+    except ImportError:
+        return
+    colorama.init()
+    Fore, Style = colorama.Fore, colorama.Style
+
+__version__ = '1.0.0'
+
+# Kinds of parsed (IR) nodes. Nodes are plain tuples, lists, strings and
+# ints so a parsed document can be stored with marshal; inline content is a
+# list of HTML strings and SPAN nodes.
+TEXT = 0        # (TEXT, inline): a line no block rule applies to
+BLOCK = 1       # (BLOCK, rule index, inline): heading, list item, table row, ...
+SPAN = 2        # (SPAN, effect name, inline): an @name{...} effect
+CODE = 3        # (CODE, [code nodes]): a fenced code block
+CODE_LINE = 4   # (CODE_LINE, line node)
+LOOP = 5        # (LOOP, css class, parts, values): one item per value, value.join(parts)
+LOOP_RANGE = 6  # (LOOP_RANGE, css class, parts, start, stop): same, for str(start) .. str(stop - 1)
+ITEMS = 7       # (ITEMS, css class, body, name, values, variables, parts): rendered value by value as it
+                # is read, see loop_items(); values is a list, or (start, stop) for a range
+ERROR = 8       # (ERROR, message)
+RAW = 9         # (RAW, HTML)
+
+# Precompiled documents: the marshalled IR, with a header checked on load
+PRECOMPILED_EXTENSION = '.mfc'
+_IR_FORMAT = 'markfunk-ir/1'
+
+# File extensions picked up when compiling a whole directory
+MARKFUNK_EXTENSIONS = ('.md', '.mdf')
+
+# Matches an ``@name{`` effect opener, both in rule patterns and in text
+_EFFECT_OPENER = re.compile(r'@(\w+)\{')
+# Class names in generated HTML, and the class a stylesheet rule belongs to
+_CLASS_ATTRIBUTE = re.compile(r'class="([^"]*)"')
+_RULE_SELECTOR = re.compile(r'(?:\.|@keyframes )([\w-]+)')
+# Whitespace --minify may drop from the stylesheet
+_CSS_SPACE = re.compile(r'\s*([{};,])\s*|(:)\s+')
+# Minifying HTML: whitespace runs, tag names, and which tags need which care
+_HTML_SPACE = re.compile(r'[ \t\n\r\f]+')
+_HTML_TAG_NAME = re.compile(r'<(/?)([A-Za-z][\w-]*|!)')
+_BLOCK_TAGS = frozenset(['!', 'html', 'head', 'title', 'meta', 'link', 'style', 'script', 'body',
+                         'div', 'p', 'pre', 'blockquote', 'hr', 'ul', 'ol', 'li',
+                         'table', 'tr', 'td', 'th', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+_VERBATIM_TAGS = frozenset(['pre', 'code', 'textarea'])
+_RAW_TEXT_TAGS = frozenset(['script', 'style'])
+# Effect openers and braces, matched up by render_effects() and parse_effects()
+_BRACE_TOKEN = re.compile(r'@(\w+)\{|[{}]')
+# Effects rewritten as a whole span (not plain wrappers) that may be open at once;
+# each character is copied once per enclosing one, so this bounds the work
+_MAX_REWRITE_DEPTH = 16
+# A {name} variable reference
+_VARIABLE = re.compile(r'\{([^{}]*)\}')
+_DOCUMENT_TAIL = '\n</body>\n</html>'
+# Largest rendered code block kept in the block cache, in characters
+_MAX_CACHED_BLOCK = 1 << 20
+# Loop items rendered between checks of the output and time limits
+_LOOP_BATCH = 256
+_REGEX_SPECIAL = set('.^$*+?{}[]|()\\')
+# Stand-in for the loop variable while a loop body is rendered once
+_LOOP_HOLE = '\x00'
+# Loop values that no rule can react to beyond where their hole already sits
+_INERT_VALUE = re.compile(r'\w+(?: \w+)*')
+# Hole positions where a value could change what the rules match
+_UNSAFE_HOLE = re.compile(r'^\x00|[\w@]\x00|\x00[\w{]')
+
+
+def _literal_hint(pattern):
+    """Return a literal every match of pattern must contain, or ''."""
+    pattern = pattern.lstrip('^')
+    if pattern.startswith(r'\s*'):
+        pattern = pattern[3:]
+    literal = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            char, step = pattern[i + 1], 2
+        elif char in _REGEX_SPECIAL:
+            break
+        else:
+            step = 1
+        if pattern[i + step:i + step + 1] in ('*', '?', '{'):
+            break
+        literal.append(char)
+        i += step
+    return ''.join(literal)
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _wrap_template(regex, replacement):
+    """Split a replacement that only wraps group 1 into (prefix, suffix).
+
+    Returns None for replacements that use other groups or escapes.
+    """
+    if regex.groups > 1:
+        return None
+    parts = replacement.split('\\1')
+    if len(parts) > 2 or (regex.groups == 0 and len(parts) > 1) or any('\\' in part for part in parts):
+        return None
+    return parts[0], parts[1] if len(parts) == 2 else ''
+
+def _utf8_size(text):
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+def _wake(waiter):
+    """Resolve an asyncio future unless it was cancelled meanwhile."""
+    if not waiter.done():
+        waiter.set_result(None)
+
+def _merge_text(parts):
+    """Join runs of adjacent strings in an inline list."""
+    merged = []
+    for part in parts:
+        if part.__class__ is str and merged and merged[-1].__class__ is str:
+            merged[-1] += part
+        elif part != '':
+            merged.append(part)
+    return merged
+
+class LRUCache:
+    """Size-bounded mapping that evicts the least recently used entry.
+
+    With max_bytes, string values are also evicted once their UTF-8 sizes
+    add up to more than that. With track_new, keys stored with put() are
+    remembered until take_new() is called, so a worker process can hand
+    freshly rendered entries back to its parent. All methods are safe to
+    call from several threads at once.
+    """
+    def __init__(self, max_size=1024, max_bytes=None, track_new=False):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.track_new = track_new
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.new = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._store(key, value)
+            if self.track_new:
+                self.new.append(key)
+
+    def _store(self, key, value):
+        if self.max_bytes is not None:
+            old = self.entries.get(key)
+            if old is not None:
+                self.bytes -= _utf8_size(old)
+            self.bytes += _utf8_size(value)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            if self.max_bytes is not None:
+                self.bytes -= _utf8_size(evicted)
+
+    def update(self, items):
+        with self.lock:
+            for key, value in items.items():
+                self._store(key, value)
+
+    def take_new(self):
+        with self.lock:
+            new = {key: self.entries[key] for key in self.new if key in self.entries}
+            self.new = []
+            return new
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.new = []
+
+# Rules of the page stylesheet, one per line; rules for a class (and its
+# @keyframes) can be left out of pages that never use that class
+STYLESHEET = [
+    '/* General Styles */',
+    'body { font-family: Arial, sans-serif; line-height: 1.6; margin: 20px; }',
+    'h1, h2, h3, h4, h5, h6 { margin: 10px 0; }',
+    'ul, ol { margin: 10px 0 10px 20px; padding: 0; }',
+    'li { margin: 5px 0; }',
+    'blockquote { margin: 10px 0 10px 20px; padding: 10px; border-left: 4px solid #ccc; }',
+    'hr { border: 0; border-top: 1px solid #ccc; margin: 20px 0; }',
+    'img { max-width: 100%; height: auto; }',
+    'a { color: #0066cc; text-decoration: none; }',
+    'a:hover { text-decoration: underline; }',
+    'pre { background: #f0f0f0; padding: 10px; border-radius: 5px; overflow-x: auto; }',
+    'code { background: #f0f0f0; padding: 2px 5px; border-radius: 3px; }',
+    '',
+    '/* Code Block Styles */',
+    '.code-block { background: #f0f0f0; padding: 15px; border-radius: 5px; }',
+    '.code-line { margin: 5px 0; }',
+    '.code-line.error { color: red; font-weight: bold; }',
+    '.foreach-loop { list-style-type: circle; }',
+    '.for-loop { list-style-type: square; }',
+    '.while-loop { list-style-type: decimal; }',
+    '.repeat-loop { list-style-type: disc; }',
+    '',
+    '/* Funky Effects */',
+    '.rainbow { animation: rainbow 3s infinite; }',
+    '@keyframes rainbow { 0% { color: red; } 50% { color: blue; } 100% { color: red; } }',
+    '.blink { animation: blink 1s infinite; }',
+    '@keyframes blink { 50% { opacity: 0; } }',
+    '.shout { text-transform: uppercase; font-weight: bold; }',
+    '.whisper { font-size: 0.8em; color: #666; }',
+    '.glow { text-shadow: 0 0 5px yellow; }',
+    '.spin { animation: spin 2s infinite linear; display: inline-block; }',
+    '@keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }',
+    '.dance { animation: dance 1s infinite; display: inline-block; }',
+    '@keyframes dance { 0% { transform: translateX(0); } 50% { transform: translateX(10px); } }',
+    '.bubble { border-radius: 50%; padding: 10px; background: #f0f0f0; display: inline-block; }',
+    '.retro { font-family: monospace; background: #000; color: #0f0; padding: 2px 5px; }',
+    '.neon { text-shadow: 0 0 10px #fff, 0 0 20px #ff00ff; }',
+    '.big { font-size: 1.5em; }',
+    '.tiny { font-size: 0.75em; }',
+    '.shadow { text-shadow: 2px 2px 4px #000; }',
+    '.flip { transform: rotate(180deg); display: inline-block; }',
+    '.wave { text-decoration: wavy underline; }',
+    '.magic { animation: magic 2s infinite; }',
+    '@keyframes magic { 0% { color: purple; } 50% { color: gold; } }',
+    '.ghost { opacity: 0.5; }',
+    '.bounce { animation: bounce 1s infinite; display: inline-block; }',
+    '@keyframes bounce { 0% { transform: translateY(0); } 50% { transform: translateY(-10px); } }',
+    '.fire { background: linear-gradient(to top, red, orange); color: white; padding: 2px 5px; }',
+    '.ice { color: lightblue; text-shadow: 0 0 5px #aaf; }',
+    '.star { animation: star 1s infinite; }',
+    '@keyframes star { 0% { text-shadow: 0 0 5px yellow; } 50% { text-shadow: 0 0 15px gold; } }',
+    '.pulse { animation: pulse 1s infinite; }',
+    '@keyframes pulse { 0% { transform: scale(1); } 50% { transform: scale(1.1); } }',
+    '.fade { animation: fade 2s infinite; }',
+    '@keyframes fade { 0% { opacity: 1; } 50% { opacity: 0.5; } }',
+    '.zoom { animation: zoom 1s infinite; }',
+    '@keyframes zoom { 0% { transform: scale(1); } 50% { transform: scale(1.2); } }',
+    '.shake { animation: shake 0.5s infinite; display: inline-block; }',
+    '@keyframes shake { 0% { transform: translateX(0); } 25% { transform: translateX(5px); } 75% { transform: translateX(-5px); } }',
+    '.glitch { animation: glitch 0.3s infinite; }',
+    '@keyframes glitch { 0% { transform: skew(0deg); } 50% { transform: skew(2deg); } }',
+    '.vaporwave { color: #ff66cc; text-shadow: 2px 2px #33ccff; }',
+    '.cyber { font-family: monospace; color: #00ff00; background: #000; padding: 2px 5px; }',
+    '.holo { color: rgba(255,255,255,0.7); text-shadow: 0 0 10px cyan; }',
+    '.metal { background: linear-gradient(45deg, #666, #999); color: #fff; padding: 2px 5px; }',
+    '.crystal { background: rgba(255,255,255,0.2); border: 1px solid rgba(255,255,255,0.5); padding: 2px 5px; }',
+    '.float { animation: float 3s infinite; display: inline-block; }',
+    '@keyframes float { 0% { transform: translateY(0); } 50% { transform: translateY(-10px); } }',
+    '.orbit { animation: orbit 4s infinite; display: inline-block; }',
+    '@keyframes orbit { 0% { transform: rotate(0deg) translateX(10px); } 100% { transform: rotate(360deg) translateX(10px); } }',
+    '.twist { animation: twist 2s infinite; display: inline-block; }',
+    '@keyframes twist { 0% { transform: rotateY(0deg); } 50% { transform: rotateY(180deg); } }',
+    '.blur { filter: blur(2px); }',
+    '.invert { filter: invert(100%); }',
+    '.sepia { filter: sepia(100%); }',
+    '.grayscale { filter: grayscale(100%); }',
+    '.rain { background: linear-gradient(to bottom, #87CEEB, #4682B4); color: white; padding: 2px 5px; }',
+    '.thunder { animation: thunder 1s infinite; }',
+    '@keyframes thunder { 0% { opacity: 1; } 10% { opacity: 0.5; } 20% { opacity: 1; } }',
+    '.sparkle { animation: sparkle 1s infinite; }',
+    '@keyframes sparkle { 0% { text-shadow: 0 0 5px white; } 50% { text-shadow: 0 0 15px yellow; } }',
+    '.warp { animation: warp 2s infinite; }',
+    '@keyframes warp { 0% { transform: scaleX(1); } 50% { transform: scaleX(1.2); } }',
+    '.pixel { font-family: monospace; image-rendering: pixelated; }',
+    '.matrix { color: #00ff00; background: #000; animation: matrix 5s infinite; }',
+    '@keyframes matrix { 0% { transform: translateY(0); } 100% { transform: translateY(20px); } }',
+    '.cosmic { background: radial-gradient(circle, #000033, #000066); color: white; padding: 2px 5px; }',
+    '.galaxy { background: linear-gradient(to right, #0f0c29, #302b63, #24243e); color: white; padding: 2px 5px; }',
+    '.nova { animation: nova 2s infinite; }',
+    '@keyframes nova { 0% { transform: scale(1); opacity: 1; } 50% { transform: scale(1.5); opacity: 0.5; } }',
+    '.eclipse { background: radial-gradient(circle, #333, #000); color: white; padding: 2px 5px; }',
+    '.aurora { background: linear-gradient(45deg, #00ffcc, #ff00ff); animation: aurora 5s infinite; }',
+    '@keyframes aurora { 0% { opacity: 0.8; } 50% { opacity: 1; } }',
+    '.prism { background: linear-gradient(45deg, red, blue, green); color: white; padding: 2px 5px; }',
+    '.fractal { animation: fractal 3s infinite; }',
+    '@keyframes fractal { 0% { transform: rotate(0deg) scale(1); } 50% { transform: rotate(90deg) scale(1.1); } }',
+    '.vortex { animation: vortex 3s infinite; display: inline-block; }',
+    '@keyframes vortex { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }',
+    '.plasma { background: radial-gradient(circle, purple, blue); animation: plasma 4s infinite; }',
+    '@keyframes plasma { 0% { opacity: 0.7; } 50% { opacity: 1; } }',
+    '.flux { animation: flux 2s infinite; }',
+    '@keyframes flux { 0% { transform: skew(0deg); } 50% { transform: skew(5deg); } }',
+    '.radiate { animation: radiate 2s infinite; }',
+    '@keyframes radiate { 0% { text-shadow: 0 0 5px white; } 50% { text-shadow: 0 0 15px white; } }',
+    '.echo { animation: echo 2s infinite; }',
+    '@keyframes echo { 0% { opacity: 1; } 50% { opacity: 0.3; } }',
+    '.ripple { animation: ripple 2s infinite; }',
+    '@keyframes ripple { 0% { transform: scale(1); } 50% { transform: scale(1.1); } }',
+    '.splash { animation: splash 1s infinite; display: inline-block; }',
+    '@keyframes splash { 0% { transform: translateY(0); } 50% { transform: translateY(-5px); } }',
+    '.drift { animation: drift 3s infinite; display: inline-block; }',
+    '@keyframes drift { 0% { transform: translateX(0); } 50% { transform: translateX(10px); } }',
+    '.surge { animation: surge 2s infinite; }',
+    '@keyframes surge { 0% { transform: scale(1); } 50% { transform: scale(1.05); } }',
+    '.tide { animation: tide 4s infinite; display: inline-block; }',
+    '@keyframes tide { 0% { transform: translateY(0); } 50% { transform: translateY(5px); } }',
+    '.mist { background: rgba(200,200,200,0.5); animation: mist 3s infinite; }',
+    '@keyframes mist { 0% { opacity: 0.5; } 50% { opacity: 0.8; } }',
+    '.flame { background: linear-gradient(to top, red, orange); color: white; padding: 2px 5px; }',
+    '.smoke { color: #666; animation: smoke 3s infinite; }',
+    '@keyframes smoke { 0% { transform: translateY(0); opacity: 1; } 100% { transform: translateY(-10px); opacity: 0.5; } }',
+    '.dust { color: #cc9966; animation: dust 2s infinite; }',
+    '@keyframes dust { 0% { opacity: 1; } 50% { opacity: 0.7; } }',
+    '.sand { background: #f4a460; color: white; padding: 2px 5px; }',
+    '.wind { animation: wind 2s infinite; display: inline-block; }',
+    '@keyframes wind { 0% { transform: translateX(0); } 50% { transform: translateX(5px); } }',
+    '.storm { background: #333; color: white; animation: storm 1s infinite; }',
+    '@keyframes storm { 0% { opacity: 1; } 10% { opacity: 0.8; } 20% { opacity: 1; } }',
+    '.shadowdance { animation: shadowdance 2s infinite; }',
+    '@keyframes shadowdance { 0% { text-shadow: 2px 2px 5px black; } 50% { text-shadow: -2px -2px 5px black; } }',
+    '.lightning { animation: lightning 0.5s infinite; }',
+    '@keyframes lightning { 0% { opacity: 1; } 10% { opacity: 0; } 20% { opacity: 1; } }',
+    '',
+    '/* Structural Elements */',
+    '.alert { border: 2px solid red; padding: 10px; }',
+    '.note { background: #f0f0f0; padding: 10px; }',
+    '.center { text-align: center; }',
+    '.right { text-align: right; }',
+    '.spoiler { background: #000; color: #000; }',
+    '.spoiler:hover { color: #fff; }',
+    '',
+    '/* Colors */',
+    '.red { color: red; }',
+    '.blue { color: blue; }',
+    '.green { color: green; }',
+    '.purple { color: purple; }',
+]
+
+def stylesheet_rules(classes=None):
+    """Return the STYLESHEET lines, keeping only the class rules in classes if given."""
+    if classes is None:
+        return list(STYLESHEET)
+    kept = []
+    for rule in STYLESHEET:
+        selector = _RULE_SELECTOR.match(rule)
+        if selector is None or selector.group(1) in classes:
+            kept.append(rule)
+    return kept
+
+def link_stylesheet(directory, page, classes=None, minify=False):
+    """Write the stylesheet to a content-hashed file in directory; returns its href from page."""
+    rules = stylesheet_rules(classes)
+    css = (minify_css(rules) if minify else '\n'.join(rules)) + '\n'
+    name = f'markfunk.{hashlib.sha256(css.encode("utf-8")).hexdigest()[:12]}.css'
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            f.write(css)
+        os.replace(temporary, path)
+    return os.path.relpath(path, os.path.dirname(page) or '.').replace(os.sep, '/')
+
+def minify_css(rules):
+    """Join stylesheet lines into one line, dropping comments and optional whitespace."""
+    css = ''.join(rule for rule in rules if rule and not rule.startswith('/*'))
+    return _CSS_SPACE.sub(r'\1\2', css).replace(';}', '}')
+
+class HtmlMinifier:
+    """Collapses whitespace in HTML written through it, then passes it on to writable.
+
+    A whitespace run becomes one space, or nothing where it touches a block
+    tag. <pre>, <code> and <textarea> contents and <script>/<style> bodies
+    are copied as they are. Writes may split the page anywhere; call
+    finish() after the last one.
+    """
+    def __init__(self, writable):
+        self.writable = writable
+        self.pending = ''    # unprocessed tail: a partial tag or raw text end tag
+        self.space = False   # whitespace seen since the last word or tag
+        self.block = True    # the last thing written was a block tag
+        self.verbatim = 0    # open <pre>, <code> and <textarea> tags
+        self.raw = None      # end tag of the <script> or <style> being copied
+
+    def write(self, text):
+        text = self.pending + text
+        out = []
+        position = 0
+        while position < len(text):
+            if self.raw is not None:
+                end = text.lower().find(self.raw, position)
+                if end < 0:
+                    # Keep enough back to spot an end tag split across writes
+                    keep = max(position, len(text) - len(self.raw))
+                    out.append(text[position:keep])
+                    position = keep
+                    break
+                out.append(text[position:end])
+                position = end
+                self.raw = None
+                continue
+            start = text.find('<', position)
+            if start < 0:
+                self.text(text[position:], out)
+                position = len(text)
+                break
+            if start > position:
+                self.text(text[position:start], out)
+            end = text.find('>', start)
+            if end < 0:
+                position = start
+                break
+            self.tag(text[start:end + 1], out)
+            position = end + 1
+        self.pending = text[position:]
+        self.writable.write(''.join(out))
+        return len(text)
+
+    def text(self, text, out):
+        if self.verbatim:
+            out.append(text)
+            return
+        for index, word in enumerate(_HTML_SPACE.split(text)):
+            if index:
+                self.space = True
+            if word:
+                if self.space and not self.block:
+                    out.append(' ')
+                out.append(word)
+                self.space = self.block = False
+
+    def tag(self, tag, out):
+        match = _HTML_TAG_NAME.match(tag)
+        closing, name = match.groups() if match else ('', '')
+        name = name.lower()
+        block = name in _BLOCK_TAGS
+        if self.space and not self.block and not block:
+            out.append(' ')
+        self.space = False
+        self.block = block
+        out.append(tag)
+        if name in _VERBATIM_TAGS:
+            self.verbatim = max(0, self.verbatim - 1) if closing else self.verbatim + 1
+        elif name in _RAW_TEXT_TAGS and not closing:
+            self.raw = f'</{name}'
+
+    def finish(self):
+        """Write out anything still held back, e.g. an unterminated tag."""
+        self.writable.write(self.pending)
+        self.pending = ''
+
+def minify_html(html):
+    """Return html with its whitespace collapsed as by HtmlMinifier."""
+    page = io.StringIO()
+    minifier = HtmlMinifier(page)
+    minifier.write(html)
+    minifier.finish()
+    return page.getvalue()
+
+class _TimedPattern:
+    """Stands in for a compiled rule regex and records [attempts, matches, seconds]."""
+    __slots__ = ('regex', 'stats')
+
+    def __init__(self, regex, stats):
+        self.regex = regex
+        self.stats = stats
+
+    def sub(self, replacement, text):
+        started = time.perf_counter()
+        text, count = self.regex.subn(replacement, text)
+        self.stats[2] += time.perf_counter() - started
+        self.stats[0] += 1
+        self.stats[1] += count
+        return text
+
+    def fullmatch(self, text):
+        started = time.perf_counter()
+        match = self.regex.fullmatch(text)
+        self.stats[2] += time.perf_counter() - started
+        self.stats[0] += 1
+        self.stats[1] += match is not None
+        return match
+
+    def __getattr__(self, name):
+        return getattr(self.regex, name)
+
+class Profiler:
+    """Per-pattern, per-loop and per-code-block timings for a MarkFunkCompiler.
+
+    attach() swaps timed wrappers onto one compiler instance and detach()
+    takes them off again, so a compiler that is never profiled runs the
+    plain class methods. Times are inclusive: a code block's time covers the
+    rules and loops run inside it.
+    """
+    _WRAPPED = ('compile_body', 'render_body', 'parse', 'render_effects', 'stream_code_block', 'parse_code_block',
+                'loop_node', 'repeat_node', 'stream_code_node')
 
-class MarkFunkCompiler:
     def __init__(self):
-         self.patterns = [
-            # Standard Markdown
-            (r'^# (.*?)$', r'<h1>\1</h1>'),
-            (r'^## (.*?)$', r'<h2>\1</h2>'),
-            (r'^### (.*?)$', r'<h3>\1</h3>'),
-            (r'^#### (.*?)$', r'<h4>\1</h4>'),  # Added H4
-            (r'^##### (.*?)$', r'<h5>\1</h5>'),  # Added H5
-            (r'^###### (.*?)$', r'<h6>\1</h6>'),  # Added H6
-            (r'\*\*(.*?)\*\*', r'<strong>\1</strong>'),  # Changed to <strong> for semantic HTML
-            (r'\*(.*?)\*', r'<em>\1</em>'),  # Changed to <em> for semantic HTML
-            (r'~~(.*?)~~', r'<del>\1</del>'),  # Changed to <del> for semantic HTML
-            (r'`(.*?)`', r'<code>\1</code>'),  # Inline code
-            (r'^- (.*?)$', r'<li>\1</li>'),  # Unordered list
-            (r'^\d+\. (.*?)$', r'<li>\1</li>'),  # Ordered list
-            (r'\[(.+?)\]\((.+?)\)', r'<a href="\2">\1</a>'),  # Links
-            (r'!\[(.+?)\]\((.+?)\)', r'<img src="\2" alt="\1">'),  # Images
-            (r'^\s*>\s*(.*?)$', r'<blockquote>\1</blockquote>'),  # Blockquote
-            (r'^\|(.+?)\|$', r'<tr><td>\1</td></tr>'),  # Simple table row
-            (r'^---$', r'<hr>'),  # Horizontal rule
-
-            # Text Effects
-            (r'@rainbow{(.*?)}', r'<span class="rainbow">\1</span>'),
-            (r'@blink{(.*?)}', r'<span class="blink">\1</span>'),
-            (r'@shout{(.*?)}', r'<span class="shout">\1</span>'),
-            (r'@whisper{(.*?)}', r'<span class="whisper">\1</span>'),
-            (r'@glow{(.*?)}', r'<span class="glow">\1</span>'),
-            (r'@spin{(.*?)}', r'<span class="spin">\1</span>'),
-            (r'@dance{(.*?)}', r'<span class="dance">\1</span>'),
-            (r'@bubble{(.*?)}', r'<span class="bubble">\1</span>'),
-            (r'@retro{(.*?)}', r'<span class="retro">\1</span>'),
-            (r'@neon{(.*?)}', r'<span class="neon">\1</span>'),
-            (r'@big{(.*?)}', r'<span class="big">\1</span>'),
-            (r'@tiny{(.*?)}', r'<span class="tiny">\1</span>'),
-            (r'@shadow{(.*?)}', r'<span class="shadow">\1</span>'),
-            (r'@flip{(.*?)}', r'<span class="flip">\1</span>'),
-            (r'@wave{(.*?)}', r'<span class="wave">\1</span>'),
-            (r'@magic{(.*?)}', r'<span class="magic">\1</span>'),
-            (r'@ghost{(.*?)}', r'<span class="ghost">\1</span>'),
-            (r'@bounce{(.*?)}', r'<span class="bounce">\1</span>'),
-            (r'@fire{(.*?)}', r'<span class="fire">\1</span>'),
-            (r'@ice{(.*?)}', r'<span class="ice">\1</span>'),
-            (r'@star{(.*?)}', r'<span class="star">\1</span>'),
-            (r'@pulse{(.*?)}', r'<span class="pulse">\1</span>'),
-            (r'@fade{(.*?)}', r'<span class="fade">\1</span>'),
-            (r'@zoom{(.*?)}', r'<span class="zoom">\1</span>'),
-            (r'@shake{(.*?)}', r'<span class="shake">\1</span>'),
-            (r'@glitch{(.*?)}', r'<span class="glitch">\1</span>'),
-            (r'@vaporwave{(.*?)}', r'<span class="vaporwave">\1</span>'),
-            (r'@cyber{(.*?)}', r'<span class="cyber">\1</span>'),
-            (r'@holo{(.*?)}', r'<span class="holo">\1</span>'),
-            (r'@metal{(.*?)}', r'<span class="metal">\1</span>'),
-            (r'@crystal{(.*?)}', r'<span class="crystal">\1</span>'),
-            (r'@float{(.*?)}', r'<span class="float">\1</span>'),
-            (r'@orbit{(.*?)}', r'<span class="orbit">\1</span>'),
-            (r'@twist{(.*?)}', r'<span class="twist">\1</span>'),
-            (r'@blur{(.*?)}', r'<span class="blur">\1</span>'),
-            (r'@invert{(.*?)}', r'<span class="invert">\1</span>'),
-            (r'@sepia{(.*?)}', r'<span class="sepia">\1</span>'),
-            (r'@grayscale{(.*?)}', r'<span class="grayscale">\1</span>'),
-            (r'@rain{(.*?)}', r'<span class="rain">\1</span>'),
-            (r'@thunder{(.*?)}', r'<span class="thunder">\1</span>'),
-            (r'@sparkle{(.*?)}', r'<span class="sparkle">\1</span>'),
-            (r'@warp{(.*?)}', r'<span class="warp">\1</span>'),
-            (r'@pixel{(.*?)}', r'<span class="pixel">\1</span>'),
-            (r'@matrix{(.*?)}', r'<span class="matrix">\1</span>'),
-            (r'@cosmic{(.*?)}', r'<span class="cosmic">\1</span>'),
-            (r'@galaxy{(.*?)}', r'<span class="galaxy">\1</span>'),
-            (r'@nova{(.*?)}', r'<span class="nova">\1</span>'),
-            (r'@eclipse{(.*?)}', r'<span class="eclipse">\1</span>'),
-            (r'@aurora{(.*?)}', r'<span class="aurora">\1</span>'),
-            (r'@prism{(.*?)}', r'<span class="prism">\1</span>'),
-            (r'@fractal{(.*?)}', r'<span class="fractal">\1</span>'),
-            (r'@vortex{(.*?)}', r'<span class="vortex">\1</span>'),
-            (r'@plasma{(.*?)}', r'<span class="plasma">\1</span>'),
-            (r'@flux{(.*?)}', r'<span class="flux">\1</span>'),
-            (r'@radiate{(.*?)}', r'<span class="radiate">\1</span>'),
-            (r'@echo{(.*?)}', r'<span class="echo">\1</span>'),
-            (r'@ripple{(.*?)}', r'<span class="ripple">\1</span>'),
-            (r'@splash{(.*?)}', r'<span class="splash">\1</span>'),
-            (r'@drift{(.*?)}', r'<span class="drift">\1</span>'),
-            (r'@surge{(.*?)}', r'<span class="surge">\1</span>'),
-            (r'@tide{(.*?)}', r'<span class="tide">\1</span>'),
-            (r'@mist{(.*?)}', r'<span class="mist">\1</span>'),
-            (r'@flame{(.*?)}', r'<span class="flame">\1</span>'),
-            (r'@smoke{(.*?)}', r'<span class="smoke">\1</span>'),
-            (r'@dust{(.*?)}', r'<span class="dust">\1</span>'),
-            (r'@sand{(.*?)}', r'<span class="sand">\1</span>'),
-            (r'@wind{(.*?)}', r'<span class="wind">\1</span>'),
-            (r'@storm{(.*?)}', r'<span class="storm">\1</span>'),
-            (r'@shadowdance{(.*?)}', r'<span class="shadowdance">\1</span>'),
-            (r'@lightning{(.*?)}', r'<span class="lightning">\1</span>'),
-
-            # Structural Elements
-            (r'@quote{(.*?)}', r'<blockquote>\1</blockquote>'),
-            (r'@alert{(.*?)}', r'<div class="alert">\1</div>'),
-            (r'@note{(.*?)}', r'<div class="note">\1</div>'),
-            (r'@code{(.*?)}', r'<pre><code>\1</code></pre>'),
-
-            # Colors
-            (r'@red{(.*?)}', r'<span class="red">\1</span>'),
-            (r'@blue{(.*?)}', r'<span class="blue">\1</span>'),
-            (r'@green{(.*?)}', r'<span class="green">\1</span>'),
-            (r'@purple{(.*?)}', r'<span class="purple">\1</span>'),
-
-            # Interactive
-            (r'@button{(.*?)}', r'<button>\1</button>'),
-            (r'@spoiler{(.*?)}', r'<span class="spoiler">\1</span>'),
-
-            # Alignment
-            (r'@center{(.*?)}', r'<div class="center">\1</div>'),
-            (r'@right{(.*?)}', r'<div class="right">\1</div>'),
-
-            # Additional Formatting
-            (r'@emoji{(.*?)}', r'<span class="emoji">\1</span>'),
-            (r'@highlight{(.*?)}', r'<mark>\1</mark>'),
-            (r'@var{(.*?)=(.*?)}', r'<span class="var" data-name="\1" data-value="\2"></span>'),
-        ]
-
-    def process_code_block(self, code_content):
+        self.rules = {}   # pattern -> [attempts, matches, seconds]
+        self.loops = {}   # loop css class -> [calls, iterations, templated, seconds]
+        self.blocks = {}  # block digest -> [first line, calls, cache hits, lines, seconds]
+        self.pages = [0, 0.0]
+        self.compiler = None
+        self._rendered_block = False
+
+    def attach(self, compiler):
+        if self.compiler is not None:
+            raise ValueError('profiler is already attached to a compiler')
+        self.compiler = compiler
+        compiler.profiler = self
+        self._saved_rules = compiler._rules, compiler._block_rules
+        timed = [_TimedPattern(regex, self.rules.setdefault(regex.pattern, [0, 0, 0.0]))
+                 for regex, _, _ in compiler._rules]
+        compiler._rules = [(timed[index],) + rule[1:] for index, rule in enumerate(compiler._rules)]
+        compiler._block_rules = [(index, timed[index]) for index, _ in compiler._block_rules]
+        for name in self._WRAPPED:
+            setattr(compiler, name, getattr(self, '_' + name)(getattr(compiler, name)))
+        return self
+
+    def detach(self):
+        """Put the compiler back as it was; collected numbers are kept."""
+        compiler = self.compiler
+        if compiler is None:
+            return
+        compiler._rules, compiler._block_rules = self._saved_rules
+        for name in self._WRAPPED:
+            compiler.__dict__.pop(name, None)
+        compiler.profiler = None
+        self.compiler = None
+
+    def _count_page(self, seconds):
+        self.pages[0] += 1
+        self.pages[1] += seconds
+
+    @staticmethod
+    def _timed(chunks, record):
+        """Pass on a generator's chunks, then call record with the seconds spent making them.
+
+        Only the generator itself is timed, not whoever consumes its chunks.
+        """
+        elapsed = 0.0
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - started
+            yield chunk
+        record(elapsed)
+
+    def _compile_body(self, original):
+        def compile_body(*args, **kwargs):
+            return self._timed(original(*args, **kwargs), self._count_page)
+        return compile_body
+
+    _render_body = _compile_body
+
+    def _parse(self, original):
+        def parse(*args, **kwargs):
+            started = time.perf_counter()
+            nodes = original(*args, **kwargs)
+            self._count_page(time.perf_counter() - started)
+            return nodes
+        return parse
+
+    def _render_effects(self, original):
+        # Effects are rendered in one scan rather than by their regexes, so
+        # they are timed together; a "match" is a line the scan changed
+        stats = self.rules.setdefault('@name{...} effects', [0, 0, 0.0])
+        def render_effects(text):
+            started = time.perf_counter()
+            html = original(text)
+            stats[2] += time.perf_counter() - started
+            stats[0] += 1
+            stats[1] += html != text
+            return html
+        return render_effects
+
+    def _block(self, code_content):
+        key = hashlib.sha1(code_content.encode('utf-8')).hexdigest()
+        first = code_content.split('\n', 1)[0].strip()
+        return self.blocks.setdefault(key, [first, 0, 0, code_content.count('\n') + 1, 0.0])
+
+    def _stream_code_block(self, original):
+        def stream_code_block(code_content, context):
+            stats = self._block(code_content)
+            self._rendered_block = False
+            def record(seconds):
+                stats[4] += seconds
+                stats[1] += 1
+                # A cache miss parses the block again
+                stats[2] += not self._rendered_block
+            return self._timed(original(code_content, context), record)
+        return stream_code_block
+
+    def _parse_code_block(self, original):
+        def parse_code_block(code_content, structured=True, context=None):
+            if not structured:  # rendering a block for stream_code_block(), timed there
+                self._rendered_block = True
+                return original(code_content, structured, context)
+            stats = self._block(code_content)
+            started = time.perf_counter()
+            nodes = list(original(code_content, structured, context))
+            stats[4] += time.perf_counter() - started
+            stats[1] += 1
+            return iter(nodes)
+        return parse_code_block
+
+    def _loop(self, css_class, started, iterations, node):
+        stats = self.loops.setdefault(css_class, [0, 0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += iterations
+        stats[2] += node[0] in (LOOP, LOOP_RANGE)
+        stats[3] += time.perf_counter() - started
+
+    def _loop_node(self, original):
+        def loop_node(css_class, content, name, values, variables):
+            started = time.perf_counter()
+            node = original(css_class, content, name, values, variables)
+            self._loop(css_class, started, len(values), node)
+            return node
+        return loop_node
+
+    def _repeat_node(self, original):
+        def repeat_node(times, content, variables):
+            started = time.perf_counter()
+            node = original(times, content, variables)
+            self._loop('repeat-loop', started, max(times, 0), node)
+            return node
+        return repeat_node
+
+    def _stream_code_node(self, original):
+        def stream_code_node(node, context=None):
+            if node[0] not in (LOOP, LOOP_RANGE, ITEMS):
+                return original(node, context)
+            # Expanding a loop happens here, as its items are read
+            stats = self.loops.setdefault(node[1], [0, 0, 0, 0.0])
+            def record(seconds):
+                stats[3] += seconds
+            return self._timed(original(node, context), record)
+        return stream_code_node
+
+    def trace(self):
+        """Return everything collected as JSON-serializable data, slowest first."""
+        by_time = lambda item: -item[1][-1]
+        return {
+            'pages': self.pages[0],
+            'seconds': self.pages[1],
+            'rules': [{'pattern': pattern, 'attempts': attempts, 'matches': matches, 'seconds': seconds}
+                      for pattern, (attempts, matches, seconds) in sorted(self.rules.items(), key=by_time)],
+            'loops': [{'loop': css_class, 'calls': calls, 'iterations': iterations, 'templated': templated,
+                       'seconds': seconds}
+                      for css_class, (calls, iterations, templated, seconds) in sorted(self.loops.items(), key=by_time)],
+            'code_blocks': [{'digest': digest, 'first_line': first, 'calls': calls, 'cache_hits': hits,
+                             'lines': lines, 'seconds': seconds}
+                            for digest, (first, calls, hits, lines, seconds) in sorted(self.blocks.items(), key=by_time)],
+        }
+
+    def report(self, top=10):
+        """Return a plain-text table of the top offenders in each category."""
+        trace = self.trace()
+        lines = [f"{trace['pages']} document pass(es) in {trace['seconds'] * 1000:.1f}ms",
+                 '', f"{'ms':>10} {'attempts':>10} {'matches':>10}  pattern"]
+        lines.extend(f"{entry['seconds'] * 1000:10.2f} {entry['attempts']:10} {entry['matches']:10}  {entry['pattern']}"
+                     for entry in trace['rules'][:top] if entry['attempts'])
+        if trace['loops']:
+            lines.extend(['', f"{'ms':>10} {'calls':>10} {'iterations':>10} {'templated':>10}  loop"])
+            lines.extend(f"{entry['seconds'] * 1000:10.2f} {entry['calls']:10} {entry['iterations']:10} "
+                         f"{entry['templated']:10}  {entry['loop']}" for entry in trace['loops'][:top])
+        if trace['code_blocks']:
+            lines.extend(['', f"{'ms':>10} {'calls':>10} {'cached':>10} {'lines':>10}  code block"])
+            lines.extend(f"{entry['seconds'] * 1000:10.2f} {entry['calls']:10} {entry['cache_hits']:10} "
+                         f"{entry['lines']:10}  {entry['digest'][:8]} {entry['first_line'][:50]}" for entry in trace['code_blocks'][:top])
+        return '\n'.join(lines)
+
+@lru_cache(maxsize=32)
+def _rule_tables(patterns):
+    """Compile a pattern table into the dispatch tables used by MarkFunkCompiler.
+
+    The tables are shared between compilers (and threads), so they are
+    returned as read-only tuples and mapping proxies.
+    """
+    rules = []
+    effects = {}
+    general = []
+    # Rules that wrap a whole line or a single @name{} argument are also
+    # kept as (prefix, suffix) pairs around their content
+    block_rules = []
+    inline_rules = []
+    block_templates = {}
+    span_templates = {}
+    for index, (pattern, replacement) in enumerate(patterns):
+        effect = _EFFECT_OPENER.match(pattern)
+        regex = re.compile(pattern)
+        rules.append((regex, replacement, None if effect else _literal_hint(pattern)))
+        template = _wrap_template(regex, replacement)
+        if effect:
+            effects.setdefault(effect.group(1), []).append(index)
+            if template is not None and pattern == f'@{effect.group(1)}{{(.*?)}}':
+                span_templates.setdefault(effect.group(1), template)
+        else:
+            general.append(index)
+            if pattern.startswith('^') and template is not None:
+                block_rules.append((index, regex))
+                block_templates[index] = template
+            else:
+                inline_rules.append(index)
+    for name, indices in effects.items():
+        if len(indices) > 1:
+            span_templates.pop(name, None)
+    effects = {name: tuple(indices) for name, indices in effects.items()}
+    return (tuple(rules), MappingProxyType(effects), tuple(general), tuple(block_rules), tuple(inline_rules),
+            MappingProxyType(block_templates), MappingProxyType(span_templates))
+
+class RenderContext:
+    """State that belongs to one compile call rather than to the compiler.
+
+    variables are the document-wide defaults code blocks start from;
+    cache_salt keeps code blocks rendered with other defaults apart in the
+    block cache. The limits (None for none) are counted from when the
+    context is made: loops may run at most max_iterations times, and the
+    body stops once it would pass max_output_bytes or time_limit seconds,
+    with the reason left in stopped. The clock is read between lines and
+    loop batches, so a single line is never cut short; the built-in rules
+    render any line in linear time.
+    """
+    __slots__ = ('variables', 'cache_salt', 'max_iterations', 'max_output_bytes', 'output_bytes',
+                 'time_limit', 'deadline', 'stopped')
+
+    def __init__(self, variables, cache_salt='', max_iterations=None, max_output_bytes=None, time_limit=None):
+        self.variables = variables
+        self.cache_salt = cache_salt
+        self.max_iterations = max_iterations
+        self.max_output_bytes = max_output_bytes
+        self.output_bytes = 0
+        self.time_limit = time_limit
+        self.deadline = time.perf_counter() + time_limit if time_limit is not None else None
+        self.stopped = None
+
+    def check(self, html):
+        """Return why html can't be added to the output, or None if it fits the limits."""
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            return f'⚠️ Time limit of {self.time_limit:g}s reached; the rest of the document was left out'
+        if self.max_output_bytes is not None:
+            if self.output_bytes + _utf8_size(html) > self.max_output_bytes:
+                return f'⚠️ Output limit of {self.max_output_bytes} bytes reached; the rest of the document was left out'
+        return None
+
+    def spend(self, html):
+        """Count html against the limits; returns False, setting stopped, if it doesn't fit."""
+        if self.stopped is None:
+            self.stopped = self.check(html)
+        if self.stopped is not None:
+            return False
+        if self.max_output_bytes is not None:
+            self.output_bytes += _utf8_size(html)
+        return True
+
+# The default pattern table: (regex, replacement) pairs. Every compiler starts
+# with its own copy; the compiled tables are shared (see build_rules).
+PATTERNS = [
+    # Standard Markdown
+    (r'^# (.*?)$', r'<h1>\1</h1>'),
+    (r'^## (.*?)$', r'<h2>\1</h2>'),
+    (r'^### (.*?)$', r'<h3>\1</h3>'),
+    (r'^#### (.*?)$', r'<h4>\1</h4>'),  # Added H4
+    (r'^##### (.*?)$', r'<h5>\1</h5>'),  # Added H5
+    (r'^###### (.*?)$', r'<h6>\1</h6>'),  # Added H6
+    (r'\*\*(.*?)\*\*', r'<strong>\1</strong>'),  # Changed to <strong> for semantic HTML
+    (r'\*(.*?)\*', r'<em>\1</em>'),  # Changed to <em> for semantic HTML
+    (r'~~(.*?)~~', r'<del>\1</del>'),  # Changed to <del> for semantic HTML
+    (r'`(.*?)`', r'<code>\1</code>'),  # Inline code
+    (r'^- (.*?)$', r'<li>\1</li>'),  # Unordered list
+    (r'^\d+\. (.*?)$', r'<li>\1</li>'),  # Ordered list
+    # Link text runs to the first "](" and the URL to the first ")"; past their
+    # first character neither crosses a "[", so a line of unclosed links is
+    # scanned in linear time rather than retried from every "["
+    (r'\[(.(?:[^\[\]]|\](?!\())*)\]\((.[^\[)]*)\)', r'<a href="\2">\1</a>'),  # Links
+    (r'!\[(.(?:[^\[\]]|\](?!\())*)\]\((.[^\[)]*)\)', r'<img src="\2" alt="\1">'),  # Images
+    (r'^\s*>\s*(.*?)$', r'<blockquote>\1</blockquote>'),  # Blockquote
+    (r'^\|(.+?)\|$', r'<tr><td>\1</td></tr>'),  # Simple table row
+    (r'^---$', r'<hr>'),  # Horizontal rule
+
+    # Text Effects
+    (r'@rainbow{(.*?)}', r'<span class="rainbow">\1</span>'),
+    (r'@blink{(.*?)}', r'<span class="blink">\1</span>'),
+    (r'@shout{(.*?)}', r'<span class="shout">\1</span>'),
+    (r'@whisper{(.*?)}', r'<span class="whisper">\1</span>'),
+    (r'@glow{(.*?)}', r'<span class="glow">\1</span>'),
+    (r'@spin{(.*?)}', r'<span class="spin">\1</span>'),
+    (r'@dance{(.*?)}', r'<span class="dance">\1</span>'),
+    (r'@bubble{(.*?)}', r'<span class="bubble">\1</span>'),
+    (r'@retro{(.*?)}', r'<span class="retro">\1</span>'),
+    (r'@neon{(.*?)}', r'<span class="neon">\1</span>'),
+    (r'@big{(.*?)}', r'<span class="big">\1</span>'),
+    (r'@tiny{(.*?)}', r'<span class="tiny">\1</span>'),
+    (r'@shadow{(.*?)}', r'<span class="shadow">\1</span>'),
+    (r'@flip{(.*?)}', r'<span class="flip">\1</span>'),
+    (r'@wave{(.*?)}', r'<span class="wave">\1</span>'),
+    (r'@magic{(.*?)}', r'<span class="magic">\1</span>'),
+    (r'@ghost{(.*?)}', r'<span class="ghost">\1</span>'),
+    (r'@bounce{(.*?)}', r'<span class="bounce">\1</span>'),
+    (r'@fire{(.*?)}', r'<span class="fire">\1</span>'),
+    (r'@ice{(.*?)}', r'<span class="ice">\1</span>'),
+    (r'@star{(.*?)}', r'<span class="star">\1</span>'),
+    (r'@pulse{(.*?)}', r'<span class="pulse">\1</span>'),
+    (r'@fade{(.*?)}', r'<span class="fade">\1</span>'),
+    (r'@zoom{(.*?)}', r'<span class="zoom">\1</span>'),
+    (r'@shake{(.*?)}', r'<span class="shake">\1</span>'),
+    (r'@glitch{(.*?)}', r'<span class="glitch">\1</span>'),
+    (r'@vaporwave{(.*?)}', r'<span class="vaporwave">\1</span>'),
+    (r'@cyber{(.*?)}', r'<span class="cyber">\1</span>'),
+    (r'@holo{(.*?)}', r'<span class="holo">\1</span>'),
+    (r'@metal{(.*?)}', r'<span class="metal">\1</span>'),
+    (r'@crystal{(.*?)}', r'<span class="crystal">\1</span>'),
+    (r'@float{(.*?)}', r'<span class="float">\1</span>'),
+    (r'@orbit{(.*?)}', r'<span class="orbit">\1</span>'),
+    (r'@twist{(.*?)}', r'<span class="twist">\1</span>'),
+    (r'@blur{(.*?)}', r'<span class="blur">\1</span>'),
+    (r'@invert{(.*?)}', r'<span class="invert">\1</span>'),
+    (r'@sepia{(.*?)}', r'<span class="sepia">\1</span>'),
+    (r'@grayscale{(.*?)}', r'<span class="grayscale">\1</span>'),
+    (r'@rain{(.*?)}', r'<span class="rain">\1</span>'),
+    (r'@thunder{(.*?)}', r'<span class="thunder">\1</span>'),
+    (r'@sparkle{(.*?)}', r'<span class="sparkle">\1</span>'),
+    (r'@warp{(.*?)}', r'<span class="warp">\1</span>'),
+    (r'@pixel{(.*?)}', r'<span class="pixel">\1</span>'),
+    (r'@matrix{(.*?)}', r'<span class="matrix">\1</span>'),
+    (r'@cosmic{(.*?)}', r'<span class="cosmic">\1</span>'),
+    (r'@galaxy{(.*?)}', r'<span class="galaxy">\1</span>'),
+    (r'@nova{(.*?)}', r'<span class="nova">\1</span>'),
+    (r'@eclipse{(.*?)}', r'<span class="eclipse">\1</span>'),
+    (r'@aurora{(.*?)}', r'<span class="aurora">\1</span>'),
+    (r'@prism{(.*?)}', r'<span class="prism">\1</span>'),
+    (r'@fractal{(.*?)}', r'<span class="fractal">\1</span>'),
+    (r'@vortex{(.*?)}', r'<span class="vortex">\1</span>'),
+    (r'@plasma{(.*?)}', r'<span class="plasma">\1</span>'),
+    (r'@flux{(.*?)}', r'<span class="flux">\1</span>'),
+    (r'@radiate{(.*?)}', r'<span class="radiate">\1</span>'),
+    (r'@echo{(.*?)}', r'<span class="echo">\1</span>'),
+    (r'@ripple{(.*?)}', r'<span class="ripple">\1</span>'),
+    (r'@splash{(.*?)}', r'<span class="splash">\1</span>'),
+    (r'@drift{(.*?)}', r'<span class="drift">\1</span>'),
+    (r'@surge{(.*?)}', r'<span class="surge">\1</span>'),
+    (r'@tide{(.*?)}', r'<span class="tide">\1</span>'),
+    (r'@mist{(.*?)}', r'<span class="mist">\1</span>'),
+    (r'@flame{(.*?)}', r'<span class="flame">\1</span>'),
+    (r'@smoke{(.*?)}', r'<span class="smoke">\1</span>'),
+    (r'@dust{(.*?)}', r'<span class="dust">\1</span>'),
+    (r'@sand{(.*?)}', r'<span class="sand">\1</span>'),
+    (r'@wind{(.*?)}', r'<span class="wind">\1</span>'),
+    (r'@storm{(.*?)}', r'<span class="storm">\1</span>'),
+    (r'@shadowdance{(.*?)}', r'<span class="shadowdance">\1</span>'),
+    (r'@lightning{(.*?)}', r'<span class="lightning">\1</span>'),
+
+    # Structural Elements
+    (r'@quote{(.*?)}', r'<blockquote>\1</blockquote>'),
+    (r'@alert{(.*?)}', r'<div class="alert">\1</div>'),
+    (r'@note{(.*?)}', r'<div class="note">\1</div>'),
+    (r'@code{(.*?)}', r'<pre><code>\1</code></pre>'),
+
+    # Colors
+    (r'@red{(.*?)}', r'<span class="red">\1</span>'),
+    (r'@blue{(.*?)}', r'<span class="blue">\1</span>'),
+    (r'@green{(.*?)}', r'<span class="green">\1</span>'),
+    (r'@purple{(.*?)}', r'<span class="purple">\1</span>'),
+
+    # Interactive
+    (r'@button{(.*?)}', r'<button>\1</button>'),
+    (r'@spoiler{(.*?)}', r'<span class="spoiler">\1</span>'),
+
+    # Alignment
+    (r'@center{(.*?)}', r'<div class="center">\1</div>'),
+    (r'@right{(.*?)}', r'<div class="right">\1</div>'),
+
+    # Additional Formatting
+    (r'@emoji{(.*?)}', r'<span class="emoji">\1</span>'),
+    (r'@highlight{(.*?)}', r'<mark>\1</mark>'),
+    (r'@var{(.*?)=(.*?)}', r'<span class="var" data-name="\1" data-value="\2"></span>'),
+]
+
+class MarkFunkCompiler:
+    """Compiles MarkFunk to HTML.
+
+    One instance can be shared by many threads: the compiled rule tables
+    are read-only, everything a compile call needs lives in its own
+    RenderContext, and the block cache is locked. Don't edit patterns,
+    variables or head_extra while compiles are running, and only profile
+    an instance used by one thread at a time.
+
+    max_iterations, max_output_bytes and time_limit (seconds) bound what
+    one compile call may do; see RenderContext. By default there are none.
+    """
+    def __init__(self, max_cached_blocks=1024, variables=None, max_workers=4, max_pending=64,
+                 max_iterations=None, max_output_bytes=None, time_limit=None):
+         self.patterns = list(PATTERNS)
+         self.block_cache = LRUCache(max_cached_blocks)
+         # Document-wide variable defaults for code blocks, escaped like @var{} values
+         self.variables = {escape(str(name)): escape(str(value)) for name, value in (variables or {}).items()}
+         # Extra lines placed at the end of <head>, e.g. the live reload script
+         self.head_extra = []
+         # The attached Profiler, if any (see enable_profiling)
+         self.profiler = None
+         # compile_async() runs on up to max_workers threads and lets at most
+         # max_pending calls, from any event loop, queue or run at once; the
+         # rest wait their turn in _waiters
+         self.max_workers = max_workers
+         self.max_pending = max_pending
+         self._executor = None
+         self._pending = 0
+         self._waiters = deque()  # futures of waiting calls, first come first served
+         self._executor_lock = threading.Lock()
+         # Per-call limits; a loop over max_iterations renders as an error, and
+         # the body is cut short once it passes max_output_bytes or time_limit
+         self.max_iterations = max_iterations
+         self.max_output_bytes = max_output_bytes
+         self.time_limit = time_limit
+         self.build_rules()
+
+    def build_rules(self):
+        """Load the single-scan dispatch tables for self.patterns.
+
+        Rules of the form ``@name{...}`` are indexed by effect name and run by
+        render_effects() as their braces close; every other rule runs first,
+        gated on the literal text it cannot match without. Tables are built
+        once per distinct pattern table and shared by every compiler using
+        it. Call this again after editing self.patterns.
+        """
+        (self._rules, self._effects, self._general, self._block_rules, self._inline_rules,
+         self._block_templates, self._span_templates) = _rule_tables(tuple(self.patterns))
+        self.block_cache.clear()
+
+    def enable_profiling(self, profiler=None):
+        """Start timing rules, loops and code blocks; returns the Profiler collecting them.
+
+        Profiling only changes this instance, so it costs nothing until
+        enabled. Enable it after the last build_rules() call.
+        """
+        self.disable_profiling()
+        return (profiler or Profiler()).attach(self)
+
+    def disable_profiling(self):
+        if self.profiler is not None:
+            self.profiler.detach()
+
+    def apply_patterns(self, text):
+        """Render one line: the non-effect rules in table order, then the @name{...} effects."""
+        for index in self._general:
+            regex, replacement, hint = self._rules[index]
+            if not hint or hint in text:
+                text = regex.sub(replacement, text)
+        return self.render_effects(text) if '{' in text else text
+
+    def render_effects(self, text):
+        """Render the @name{...} effects in text in a single left-to-right scan.
+
+        Braces are matched with an explicit stack, so effects nest to any
+        depth in linear time. Openers that never close, unknown effect names
+        and stray braces are kept as plain text, as are effects that have to
+        be rewritten whole once more than _MAX_REWRITE_DEPTH of them are open.
+        """
+        effects = self._effects
+        templates = self._span_templates
+        out = []
+        stack = []  # (effect name or None, position of its opener in out)
+        rewrites = 0
+        position = 0
+        for match in _BRACE_TOKEN.finditer(text):
+            if match.start() > position:
+                out.append(text[position:match.start()])
+            position = match.end()
+            token = match.group(0)
+            if token != '}':
+                name = match.group(1)
+                if name not in effects:
+                    name = None
+                elif name not in templates:
+                    if rewrites == _MAX_REWRITE_DEPTH:
+                        name = None
+                    else:
+                        rewrites += 1
+                stack.append((name, len(out)))
+                out.append(token)
+            elif not stack:
+                out.append(token)
+            else:
+                name, opened = stack.pop()
+                template = templates.get(name)
+                if template is not None:
+                    out[opened] = template[0]
+                    out.append(template[1])
+                elif name is not None:
+                    rewrites -= 1
+                    rendered = self.rewrite_effect(name, ''.join(out[opened:]) + '}')
+                    del out[opened:]
+                    out.append(rendered)
+                else:
+                    out.append(token)
+        out.append(text[position:])
+        return ''.join(out)
+
+    def rewrite_effect(self, name, span):
+        """Render a whole ``@name{...}`` span with the rules for an effect that is not a plain wrapper.
+
+        Each rule must match the entire span, so it runs once in linear time;
+        a span no rule matches stays as text.
+        """
+        for index in self._effects[name]:
+            regex, replacement, _ = self._rules[index]
+            match = regex.fullmatch(span)
+            if match is not None:
+                span = match.expand(replacement)
+        return span
+
+    def fingerprint(self, *extra):
+        """Identify what this compiler renders: its version, pattern table, variables and any extra settings."""
+        state = (__version__, self.patterns, sorted(self.variables.items()))
+        return hashlib.sha256(repr(state + extra).encode('utf-8')).hexdigest()
+
+    def render_context(self, variables=None):
+        """Return the context for one compile call, with extra variable defaults for this call only.
+
+        The call's time limit starts counting now.
+        """
+        scope, salt = self.variables, ''
+        if variables:
+            scope = ChainMap({escape(str(name)): escape(str(value)) for name, value in variables.items()}, self.variables)
+            salt = repr(sorted(scope.items())) + '\x00'
+        if self.max_iterations is not None:
+            # Loops over the limit render differently, so keep their blocks apart
+            salt += f'max_iterations={self.max_iterations}\x00'
+        return RenderContext(scope, salt, self.max_iterations, self.max_output_bytes, self.time_limit)
+
+    def process_code_block(self, code_content, context=None):
+        """Render a fenced code block, reusing the output for a body seen before."""
+        return ''.join(self.stream_code_block(code_content, context or self.render_context()))
+
+    def stream_code_block(self, code_content, context):
+        """Yield the HTML of a fenced code block in pieces, as its loops expand.
+
+        A block seen before comes from the block cache. A freshly rendered
+        one is cached if it was rendered in full and is no larger than
+        _MAX_CACHED_BLOCK characters.
+        """
+        key = hashlib.sha1((context.cache_salt + code_content).encode('utf-8')).hexdigest()
+        html = self.block_cache.get(key)
+        if html is not None and context.check(html) is None:
+            context.spend(html)
+            yield html
+            return
+        # Not cached, or too big for what the limits leave: render it, stopping where a limit is hit
+        nodes = self.parse_code_block(code_content, structured=False, context=context)
+        kept = []
+        size = 0
+        for piece in self.stream_code_nodes(nodes, context):
+            if kept is not None:
+                size += len(piece)
+                if size > _MAX_CACHED_BLOCK:
+                    kept = None
+                else:
+                    kept.append(piece)
+            yield piece
+        if kept is not None and context.stopped is None:
+            self.block_cache.put(key, ''.join(kept))
+
+    def parse_code_block(self, code_content, structured=True, context=None):
+        """Yield the IR nodes for the body of a fenced code block.
+
+        Loops over context.max_iterations become ERROR nodes.
+        """
         lines = code_content.split('\n')
-        html_lines = []
-        variables = {}
+        context = context or self.render_context()
+        limit = context.max_iterations
+        # @var{} definitions shadow the document defaults for this block only
+        variables = ChainMap({}, context.variables)
         
         for line in lines:
             line = escape(line.strip())
@@ -142,334 +1116,1393 @@ class MarkFunkCompiler:
                     variables[name] = value
                     continue
             
+            # (css class, body, counter name, values) of a loop on this line
+            loop = None
             if line.startswith('@foreach{'):
                 items = re.search(r'@foreach{(.*?)}:(.*)', line)
                 if items:
                     list_items, content = items.groups()
-                    html_lines.append(self.process_foreach(list_items, content, variables))
+                    loop = ('foreach-loop', content, 'item', [item.strip() for item in list_items.split(',')])
                 else:
-                    html_lines.append(f'<div class="code-line error">⚠️ Invalid @foreach syntax: {line}</div>')
+                    node = (ERROR, f'⚠️ Invalid @foreach syntax: {line}')
             
             elif line.startswith('@for{'):
                 range_match = re.search(r'@for{(\d+)-(\d+)}:(.*)', line)
                 if range_match:
                     start, end, content = range_match.groups()
-                    html_lines.append(self.process_for(int(start), int(end), content, variables))
+                    loop = ('for-loop', content, 'i', range(int(start), int(end) + 1))
                 else:
-                    html_lines.append(f'<div class="code-line error">⚠️ Invalid @for syntax: {line}</div>')
+                    node = (ERROR, f'⚠️ Invalid @for syntax: {line}')
             
             elif line.startswith('@while{'):
                 count_match = re.search(r'@while{(\d+)}:(.*)', line)
                 if count_match:
                     count, content = count_match.groups()
-                    html_lines.append(self.process_while(int(count), content, variables))
+                    loop = ('while-loop', content, 'i', range(int(count)))
                 else:
-                    html_lines.append(f'<div class="code-line error">⚠️ Invalid @while syntax: {line}</div>')
+                    node = (ERROR, f'⚠️ Invalid @while syntax: {line}')
             
             elif line.startswith('@repeat{'):
                 repeat_match = re.search(r'@repeat{(\d+)}:(.*)', line)
                 if repeat_match:
                     times, content = repeat_match.groups()
-                    html_lines.append(self.process_repeat(int(times), content, variables))
+                    loop = ('repeat-loop', content, None, range(int(times)))
                 else:
-                    html_lines.append(f'<div class="code-line error">⚠️ Invalid @repeat syntax: {line}</div>')
+                    node = (ERROR, f'⚠️ Invalid @repeat syntax: {line}')
             
             else:
                 processed_line = self.replace_vars(line, variables)
-                for pattern, replacement in self.patterns:
-                    processed_line = re.sub(pattern, replacement, processed_line)
-                html_lines.append(f'<div class="code-line">{processed_line}</div>')
-        
-        return '\n'.join(html_lines)
+                node = (CODE_LINE, self.parse_line(processed_line, structured) or (TEXT, ['']))
+
+            if loop is not None:
+                css_class, content, name, values = loop
+                # len() of a huge range overflows, so count it by hand
+                iterations = max(0, values.stop - values.start) if isinstance(values, range) else len(values)
+                if limit is not None and iterations > limit:
+                    node = (ERROR, f'⚠️ Loop runs {iterations} times, more than the limit of {limit}: {line}')
+                elif name is None:
+                    node = self.repeat_node(iterations, content, variables)
+                else:
+                    node = self.loop_node(css_class, content, name, values, variables)
+            yield node
 
     def replace_vars(self, content, variables):
-        for name, value in variables.items():
-            content = content.replace(f'{{{name}}}', value)
-        return content
+        """Replace every {name} in content with its value in one scan.
+
+        variables is any mapping, e.g. a ChainMap of scopes. Unknown names are
+        left alone, and substituted values are not scanned again.
+        """
+        if '{' not in content:
+            return content
+        return _VARIABLE.sub(lambda match: variables.get(match.group(1), match.group(0)), content)
+
+    def compile_loop_body(self, content, name, variables):
+        """Render a loop body once, leaving a hole wherever {name} appears.
+
+        Returns the list of parts that joining with a value gives the rendered
+        iteration, or None when the body has to be rendered per iteration. A
+        hole is only kept where an inert value (see _INERT_VALUE) cannot reach
+        any rule: not at the start of the line, not touching word characters,
+        and not turning into an @name{ opener.
+        """
+        if _LOOP_HOLE in content or any(_LOOP_HOLE in value for value in variables.values()):
+            return None
+        body = self.replace_vars(content, ChainMap({name: _LOOP_HOLE}, variables))
+        if _UNSAFE_HOLE.search(body):
+            return None
+        holes = body.count(_LOOP_HOLE)
+        rendered = self.apply_patterns(body)
+        if rendered.count(_LOOP_HOLE) != holes:
+            return None
+        return rendered.split(_LOOP_HOLE)
+
+    def loop_node(self, css_class, content, name, values, variables):
+        """Build the node for a loop binding {name} to each of values, using a body template where possible.
+
+        Without a template, the ITEMS node keeps the body, values and a copy
+        of variables, and its items are only rendered as they are output.
+        """
+        parts = self.compile_loop_body(content, name, variables)
+        if parts is not None:
+            if isinstance(values, range):
+                # str(i) is always inert
+                return (LOOP_RANGE, css_class, parts, values.start, values.stop)
+            if len(parts) == 1 or all(_INERT_VALUE.fullmatch(value) for value in values):
+                return (LOOP, css_class, parts, list(values))
+        if isinstance(values, range):
+            values = (values.start, values.stop)
+        return (ITEMS, css_class, content, name, values, dict(variables), parts)
+
+    def loop_items(self, content, name, values, variables, parts=None):
+        """Yield the rendered body for each value, filling parts where a value is inert."""
+        scope = {}
+        variables = ChainMap(scope, variables)
+        for value in values:
+            value = str(value)
+            if parts is not None and _INERT_VALUE.fullmatch(value):
+                yield value.join(parts)
+            else:
+                scope[name] = value
+                yield self.apply_patterns(self.replace_vars(content, variables))
+
+    def repeat_node(self, times, content, variables):
+        processed = self.replace_vars(content, variables)
+        processed = self.apply_patterns(processed)
+        return (LOOP_RANGE, 'repeat-loop', [processed], 0, times)
 
     def process_foreach(self, items, content, variables):
         item_list = [item.strip() for item in items.split(',')]
-        result = ['<ul class="foreach-loop">']
-        for item in item_list:
-            processed = content.replace('{item}', item)
-            processed = self.replace_vars(processed, variables)
-            for pattern, replacement in self.patterns:
-                processed = re.sub(pattern, replacement, processed)
-            result.append(f'<li>{processed}</li>')
-        result.append('</ul>')
-        return '\n'.join(result)
+        return self.render_code_node(self.loop_node('foreach-loop', content, 'item', item_list, variables))
 
     def process_for(self, start, end, content, variables):
-        result = ['<ul class="for-loop">']
-        for i in range(start, end + 1):
-            processed = content.replace('{i}', str(i))
-            processed = self.replace_vars(processed, variables)
-            for pattern, replacement in self.patterns:
-                processed = re.sub(pattern, replacement, processed)
-            result.append(f'<li>{processed}</li>')
-        result.append('</ul>')
-        return '\n'.join(result)
+        return self.render_code_node(self.loop_node('for-loop', content, 'i', range(start, end + 1), variables))
 
     def process_while(self, count, content, variables):
-        result = ['<ul class="while-loop">']
-        i = 0
-        while i < count:
-            processed = content.replace('{i}', str(i))
-            processed = self.replace_vars(processed, variables)
-            for pattern, replacement in self.patterns:
-                processed = re.sub(pattern, replacement, processed)
-            result.append(f'<li>{processed}</li>')
-            i += 1
-        result.append('</ul>')
-        return '\n'.join(result)
+        return self.render_code_node(self.loop_node('while-loop', content, 'i', range(count), variables))
 
     def process_repeat(self, times, content, variables):
-        result = ['<ul class="repeat-loop">']
-        for _ in range(times):
-            processed = self.replace_vars(content, variables)
-            for pattern, replacement in self.patterns:
-                processed = re.sub(pattern, replacement, processed)
-            result.append(f'<li>{processed}</li>')
-        result.append('</ul>')
-        return '\n'.join(result)
-
-    def compile(self, markfunk_text):
-        html = ['<!DOCTYPE html>',
+        return self.render_code_node(self.repeat_node(times, content, variables))
+
+    def parse_line(self, line, structured=True):
+        """Parse an escaped line into a TEXT or BLOCK node; None if it renders empty.
+
+        The structured parse splits out the block rule and effect spans, and is
+        only kept if it renders exactly like apply_patterns(); otherwise, and
+        without structured, the node just carries the rendered HTML.
+        """
+        html = self.apply_patterns(line)
+        if not html:
+            return None
+        if not structured:
+            return (TEXT, [html])
+        for index, regex in self._block_rules:
+            match = regex.fullmatch(line)
+            if match:
+                node = (BLOCK, index, self.parse_inline(match.group(1) if regex.groups else ''))
+                break
+        else:
+            node = (TEXT, self.parse_inline(line))
+        if self.render_line(node) != html:
+            return (TEXT, [html])
+        return node
+
+    def parse_inline(self, text):
+        """Parse inline text into HTML strings and SPAN nodes.
+
+        The non-effect rules are applied first, as in apply_patterns(); then
+        @name{...} effects are matched against their closing braces.
+        """
+        for index in self._inline_rules:
+            regex, replacement, hint = self._rules[index]
+            if not hint or hint in text:
+                text = regex.sub(replacement, text)
+        return self.parse_effects(text)
+
+    def parse_effects(self, text):
+        """Split text into HTML strings and SPAN nodes with an explicit brace stack."""
+        root = []
+        stack = [(None, None, root)]  # (effect name, opening text, parts)
+        rewrites = 0
+        position = 0
+        for match in _BRACE_TOKEN.finditer(text):
+            parts = stack[-1][2]
+            if match.start() > position:
+                parts.append(text[position:match.start()])
+            position = match.end()
+            token = match.group(0)
+            if token != '}':
+                name = match.group(1)
+                if name not in self._effects:
+                    name = None
+                elif name not in self._span_templates:
+                    if rewrites == _MAX_REWRITE_DEPTH:
+                        name = None
+                    else:
+                        rewrites += 1
+                stack.append((name, token, []))
+            elif len(stack) == 1:
+                parts.append(token)
+            else:
+                name, opening, inner = stack.pop()
+                parent = stack[-1][2]
+                if name in self._span_templates:
+                    parent.append((SPAN, name, _merge_text(inner)))
+                elif name is not None:
+                    rewrites -= 1
+                    parent.append(self.rewrite_effect(name, f'@{name}{{{self.render_inline(inner)}}}'))
+                else:
+                    parent.append(opening)
+                    parent.extend(inner)
+                    parent.append('}')
+        if position < len(text):
+            stack[-1][2].append(text[position:])
+        while len(stack) > 1:
+            _, opening, inner = stack.pop()
+            stack[-1][2].append(opening)
+            stack[-1][2].extend(inner)
+        return _merge_text(root)
+
+    def render_inline(self, inline):
+        out = []
+        stack = [(iter(inline), '')]
+        while stack:
+            for part in stack[-1][0]:
+                if part.__class__ is str:
+                    out.append(part)
+                else:
+                    prefix, suffix = self._span_templates[part[1]]
+                    out.append(prefix)
+                    stack.append((iter(part[2]), suffix))
+                    break
+            else:
+                out.append(stack.pop()[1])
+        return ''.join(out)
+
+    def render_line(self, node):
+        if node[0] == BLOCK:
+            prefix, suffix = self._block_templates[node[1]]
+            return prefix + self.render_inline(node[2]) + suffix
+        return self.render_inline(node[1])
+
+    def render_code_node(self, node):
+        return ''.join(self.stream_code_node(node))
+
+    def stream_code_nodes(self, nodes, context=None):
+        """Yield the HTML of code block nodes, a line apart, until context stops the output."""
+        for index, node in enumerate(nodes):
+            if index:
+                yield '\n'
+            yield from self.stream_code_node(node, context)
+            if context is not None and context.stopped is not None:
+                return
+
+    def stream_code_node(self, node, context=None):
+        """Yield the HTML of one code block node; loops come _LOOP_BATCH items at a time.
+
+        Each piece is counted against context's limits first, and with a
+        max_output_bytes each loop item is; a loop cut short still closes
+        its list.
+        """
+        kind = node[0]
+        if kind == LOOP:
+            items = (value.join(node[2]) for value in node[3])
+        elif kind == LOOP_RANGE:
+            items = (str(i).join(node[2]) for i in range(node[3], node[4]))
+        elif kind == ITEMS:
+            values = range(*node[4]) if node[4].__class__ is tuple else node[4]
+            items = self.loop_items(node[2], node[3], values, node[5], node[6])
+        else:
+            if kind == CODE_LINE:
+                html = f'<div class="code-line">{self.render_line(node[1])}</div>'
+            elif kind == ERROR:
+                html = f'<div class="code-line error">{node[1]}</div>'
+            else:
+                html = node[1]
+            if context is None or context.spend(html):
+                yield html
+            return
+        yield f'<ul class="{node[1]}">'
+        if context is not None and context.max_output_bytes is not None:
+            # A batch could overshoot the limit by far more than one item
+            for item in items:
+                html = f'\n<li>{item}</li>'
+                if not context.spend(html):
+                    break
+                yield html
+            yield '\n</ul>'
+            return
+        batch = []
+        for item in items:
+            batch.append(f'\n<li>{item}</li>')
+            if len(batch) == _LOOP_BATCH:
+                html = ''.join(batch)
+                if context is not None and not context.spend(html):
+                    break
+                yield html
+                batch = []
+        else:
+            html = ''.join(batch)
+            if html and (context is None or context.spend(html)):
+                yield html
+        yield '\n</ul>'
+
+    def compile(self, markfunk_text, variables=None, minify=False):
+        """Compile a document to an HTML page; variables add defaults for this call only.
+
+        With minify, whitespace the page doesn't need is left out (see HtmlMinifier).
+        """
+        if minify:
+            page = io.StringIO()
+            self.compile_stream(markfunk_text.split('\n'), page, variables=variables, minify=True)
+            return page.getvalue()
+        return ''.join(self.compile_iter(markfunk_text.split('\n'), variables=variables))
+
+    async def compile_async(self, markfunk_text, variables=None):
+        """compile() on a worker thread, without blocking the event loop.
+
+        At most max_pending calls, across all event loops, are queued or
+        running at once; further callers wait here until one finishes.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        waiter = None
+        with self._executor_lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='markfunk')
+            if self._pending < self.max_pending:
+                self._pending += 1
+            else:
+                waiter = loop.create_future()
+                self._waiters.append(waiter)
+        if waiter is not None:
+            try:
+                await waiter  # Done once a finishing call has handed over its slot
+            except asyncio.CancelledError:
+                with self._executor_lock:
+                    handed_over = waiter not in self._waiters
+                    if not handed_over:
+                        self._waiters.remove(waiter)
+                if handed_over:
+                    self._release_pending()
+                raise
+        try:
+            return await loop.run_in_executor(self._executor, self.compile, markfunk_text, variables)
+        finally:
+            self._release_pending()
+
+    def _release_pending(self):
+        """Hand a compile_async() slot to the longest waiting call, or free it."""
+        with self._executor_lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                try:
+                    waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+                    return
+                except RuntimeError:  # Its event loop has been closed
+                    continue
+            self._pending -= 1
+
+    def close(self):
+        """Stop the compile_async() worker threads, waiting for running compiles."""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def compile_stream(self, readable, writable, purge_css=False, link=None, variables=None, minify=False):
+        """Compile lines read from readable, writing HTML to writable as it goes.
+
+        link, if given, is called with the set of classes to keep (None for
+        all) and returns the href of an external stylesheet to use instead of
+        an inline <style>. With purge_css the stylesheet only keeps rules for
+        classes the page uses; the body is then spooled until the end so the
+        head can be written first. minify collapses the page's whitespace as
+        it is written, leaving preformatted text alone.
+        """
+        self.write_document(self.compile_body(readable, variables), writable, purge_css, link, minify)
+
+    def write_document(self, body, writable, purge_css=False, link=None, minify=False):
+        """Write a full page around an iterable of body chunks (see compile_stream)."""
+        if minify:
+            writable = HtmlMinifier(writable)
+        if not purge_css:
+            writable.write(self.render_head(link(None) if link else None, minify=minify))
+            for chunk in body:
+                writable.write(chunk)
+            writable.write(_DOCUMENT_TAIL)
+            if minify:
+                writable.finish()
+            return
+        classes = set()
+        import shutil
+        import tempfile
+        with tempfile.SpooledTemporaryFile(max_size=1 << 22, mode='w+', encoding='utf-8') as spool:
+            for chunk in body:
+                for names in _CLASS_ATTRIBUTE.findall(chunk):
+                    classes.update(names.split())
+                spool.write(chunk)
+            writable.write(self.render_head(link(classes) if link else None, classes, minify))
+            spool.seek(0)
+            shutil.copyfileobj(spool, writable)
+        writable.write(_DOCUMENT_TAIL)
+        if minify:
+            writable.finish()
+
+    def parse(self, lines, variables=None):
+        """Parse MarkFunk lines into a list of IR nodes that render() turns into a page."""
+        return list(self.parse_body(lines, variables=variables))
+
+    def render(self, nodes):
+        return ''.join(self.render_iter(nodes))
+
+    def render_iter(self, nodes, stylesheet_href=None, classes=None):
+        yield self.render_head(stylesheet_href, classes)
+        yield from self.render_body(nodes)
+        yield _DOCUMENT_TAIL
+
+    def render_stream(self, nodes, writable, purge_css=False, link=None, minify=False):
+        """Like compile_stream(), for an already parsed document."""
+        self.write_document(self.render_body(nodes), writable, purge_css, link, minify)
+
+    def render_body(self, nodes):
+        yield from self.stream_body(nodes, self.render_context())
+
+    def stream_body(self, nodes, context):
+        """Yield the HTML for body-level nodes in chunks, until context stops the output.
+
+        A CODE node holds code block nodes or, from an unstructured parse,
+        its HTML in pieces. When a limit is hit the reason is written as an
+        error line, and the rest of the nodes are dropped.
+        """
+        for node in nodes:
+            if node[0] == CODE:
+                pieces = node[1]
+                if pieces.__class__ is list:
+                    pieces = self.stream_code_nodes(pieces, context)
+                yield '\n<div class="code-block">\n'
+                yield from pieces
+                if context.stopped is not None:
+                    yield f'\n<div class="code-line error">{context.stopped}</div>'
+                yield '\n</div>'
+            else:
+                html = '\n' + self.render_line(node)
+                if context.spend(html):
+                    yield html
+                else:
+                    yield f'\n<div class="code-line error">{context.stopped}</div>'
+            if context.stopped is not None:
+                return
+
+    def dump(self, nodes, file):
+        """Write parsed nodes to a binary file as a precompiled (.mfc) document."""
+        marshal.dump((_IR_FORMAT, self.fingerprint(), nodes), file)
+
+    def load(self, file):
+        """Read nodes written by dump(); raises ValueError if they were made by another compiler."""
+        try:
+            header, fingerprint, nodes = marshal.load(file)
+        except (EOFError, TypeError, ValueError):
+            raise ValueError('not a precompiled MarkFunk document')
+        if header != _IR_FORMAT or fingerprint != self.fingerprint():
+            raise ValueError('precompiled with a different MarkFunk version or pattern table; compile it again')
+        return nodes
+
+    def compile_iter(self, lines, stylesheet_href=None, classes=None, variables=None):
+        """Yield the HTML for an iterable of MarkFunk lines, chunk by chunk.
+
+        Lines may keep their trailing newline, so a file object can be passed
+        directly. Only the current fenced code block is held in memory.
+        """
+        yield self.render_head(stylesheet_href, classes)
+        yield from self.compile_body(lines, variables)
+        yield _DOCUMENT_TAIL
+
+    def render_head(self, stylesheet_href=None, classes=None, minify=False):
+        """Return the document up to <body>, linking or inlining the stylesheet."""
+        head = ['<!DOCTYPE html>',
 '<html>',
 '<head>',
 '<meta charset="UTF-8">',
-'<title>MarkFunk Document</title>',
-'<style>',
-'/* General Styles */',
-'body { font-family: Arial, sans-serif; line-height: 1.6; margin: 20px; }',
-'h1, h2, h3, h4, h5, h6 { margin: 10px 0; }',
-'ul, ol { margin: 10px 0 10px 20px; padding: 0; }',
-'li { margin: 5px 0; }',
-'blockquote { margin: 10px 0 10px 20px; padding: 10px; border-left: 4px solid #ccc; }',
-'hr { border: 0; border-top: 1px solid #ccc; margin: 20px 0; }',
-'img { max-width: 100%; height: auto; }',
-'a { color: #0066cc; text-decoration: none; }',
-'a:hover { text-decoration: underline; }',
-'pre { background: #f0f0f0; padding: 10px; border-radius: 5px; overflow-x: auto; }',
-'code { background: #f0f0f0; padding: 2px 5px; border-radius: 3px; }',
-'',
-'/* Code Block Styles */',
-'.code-block { background: #f0f0f0; padding: 15px; border-radius: 5px; }',
-'.code-line { margin: 5px 0; }',
-'.code-line.error { color: red; font-weight: bold; }',
-'.foreach-loop { list-style-type: circle; }',
-'.for-loop { list-style-type: square; }',
-'.while-loop { list-style-type: decimal; }',
-'.repeat-loop { list-style-type: disc; }',
-'',
-'/* Funky Effects */',
-'.rainbow { animation: rainbow 3s infinite; }',
-'@keyframes rainbow { 0% { color: red; } 50% { color: blue; } 100% { color: red; } }',
-'.blink { animation: blink 1s infinite; }',
-'@keyframes blink { 50% { opacity: 0; } }',
-'.shout { text-transform: uppercase; font-weight: bold; }',
-'.whisper { font-size: 0.8em; color: #666; }',
-'.glow { text-shadow: 0 0 5px yellow; }',
-'.spin { animation: spin 2s infinite linear; display: inline-block; }',
-'@keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }',
-'.dance { animation: dance 1s infinite; display: inline-block; }',
-'@keyframes dance { 0% { transform: translateX(0); } 50% { transform: translateX(10px); } }',
-'.bubble { border-radius: 50%; padding: 10px; background: #f0f0f0; display: inline-block; }',
-'.retro { font-family: monospace; background: #000; color: #0f0; padding: 2px 5px; }',
-'.neon { text-shadow: 0 0 10px #fff, 0 0 20px #ff00ff; }',
-'.big { font-size: 1.5em; }',
-'.tiny { font-size: 0.75em; }',
-'.shadow { text-shadow: 2px 2px 4px #000; }',
-'.flip { transform: rotate(180deg); display: inline-block; }',
-'.wave { text-decoration: wavy underline; }',
-'.magic { animation: magic 2s infinite; }',
-'@keyframes magic { 0% { color: purple; } 50% { color: gold; } }',
-'.ghost { opacity: 0.5; }',
-'.bounce { animation: bounce 1s infinite; display: inline-block; }',
-'@keyframes bounce { 0% { transform: translateY(0); } 50% { transform: translateY(-10px); } }',
-'.fire { background: linear-gradient(to top, red, orange); color: white; padding: 2px 5px; }',
-'.ice { color: lightblue; text-shadow: 0 0 5px #aaf; }',
-'.star { animation: star 1s infinite; }',
-'@keyframes star { 0% { text-shadow: 0 0 5px yellow; } 50% { text-shadow: 0 0 15px gold; } }',
-'.pulse { animation: pulse 1s infinite; }',
-'@keyframes pulse { 0% { transform: scale(1); } 50% { transform: scale(1.1); } }',
-'.fade { animation: fade 2s infinite; }',
-'@keyframes fade { 0% { opacity: 1; } 50% { opacity: 0.5; } }',
-'.zoom { animation: zoom 1s infinite; }',
-'@keyframes zoom { 0% { transform: scale(1); } 50% { transform: scale(1.2); } }',
-'.shake { animation: shake 0.5s infinite; display: inline-block; }',
-'@keyframes shake { 0% { transform: translateX(0); } 25% { transform: translateX(5px); } 75% { transform: translateX(-5px); } }',
-'.glitch { animation: glitch 0.3s infinite; }',
-'@keyframes glitch { 0% { transform: skew(0deg); } 50% { transform: skew(2deg); } }',
-'.vaporwave { color: #ff66cc; text-shadow: 2px 2px #33ccff; }',
-'.cyber { font-family: monospace; color: #00ff00; background: #000; padding: 2px 5px; }',
-'.holo { color: rgba(255,255,255,0.7); text-shadow: 0 0 10px cyan; }',
-'.metal { background: linear-gradient(45deg, #666, #999); color: #fff; padding: 2px 5px; }',
-'.crystal { background: rgba(255,255,255,0.2); border: 1px solid rgba(255,255,255,0.5); padding: 2px 5px; }',
-'.float { animation: float 3s infinite; display: inline-block; }',
-'@keyframes float { 0% { transform: translateY(0); } 50% { transform: translateY(-10px); } }',
-'.orbit { animation: orbit 4s infinite; display: inline-block; }',
-'@keyframes orbit { 0% { transform: rotate(0deg) translateX(10px); } 100% { transform: rotate(360deg) translateX(10px); } }',
-'.twist { animation: twist 2s infinite; display: inline-block; }',
-'@keyframes twist { 0% { transform: rotateY(0deg); } 50% { transform: rotateY(180deg); } }',
-'.blur { filter: blur(2px); }',
-'.invert { filter: invert(100%); }',
-'.sepia { filter: sepia(100%); }',
-'.grayscale { filter: grayscale(100%); }',
-'.rain { background: linear-gradient(to bottom, #87CEEB, #4682B4); color: white; padding: 2px 5px; }',
-'.thunder { animation: thunder 1s infinite; }',
-'@keyframes thunder { 0% { opacity: 1; } 10% { opacity: 0.5; } 20% { opacity: 1; } }',
-'.sparkle { animation: sparkle 1s infinite; }',
-'@keyframes sparkle { 0% { text-shadow: 0 0 5px white; } 50% { text-shadow: 0 0 15px yellow; } }',
-'.warp { animation: warp 2s infinite; }',
-'@keyframes warp { 0% { transform: scaleX(1); } 50% { transform: scaleX(1.2); } }',
-'.pixel { font-family: monospace; image-rendering: pixelated; }',
-'.matrix { color: #00ff00; background: #000; animation: matrix 5s infinite; }',
-'@keyframes matrix { 0% { transform: translateY(0); } 100% { transform: translateY(20px); } }',
-'.cosmic { background: radial-gradient(circle, #000033, #000066); color: white; padding: 2px 5px; }',
-'.galaxy { background: linear-gradient(to right, #0f0c29, #302b63, #24243e); color: white; padding: 2px 5px; }',
-'.nova { animation: nova 2s infinite; }',
-'@keyframes nova { 0% { transform: scale(1); opacity: 1; } 50% { transform: scale(1.5); opacity: 0.5; } }',
-'.eclipse { background: radial-gradient(circle, #333, #000); color: white; padding: 2px 5px; }',
-'.aurora { background: linear-gradient(45deg, #00ffcc, #ff00ff); animation: aurora 5s infinite; }',
-'@keyframes aurora { 0% { opacity: 0.8; } 50% { opacity: 1; } }',
-'.prism { background: linear-gradient(45deg, red, blue, green); color: white; padding: 2px 5px; }',
-'.fractal { animation: fractal 3s infinite; }',
-'@keyframes fractal { 0% { transform: rotate(0deg) scale(1); } 50% { transform: rotate(90deg) scale(1.1); } }',
-'.vortex { animation: vortex 3s infinite; display: inline-block; }',
-'@keyframes vortex { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }',
-'.plasma { background: radial-gradient(circle, purple, blue); animation: plasma 4s infinite; }',
-'@keyframes plasma { 0% { opacity: 0.7; } 50% { opacity: 1; } }',
-'.flux { animation: flux 2s infinite; }',
-'@keyframes flux { 0% { transform: skew(0deg); } 50% { transform: skew(5deg); } }',
-'.radiate { animation: radiate 2s infinite; }',
-'@keyframes radiate { 0% { text-shadow: 0 0 5px white; } 50% { text-shadow: 0 0 15px white; } }',
-'.echo { animation: echo 2s infinite; }',
-'@keyframes echo { 0% { opacity: 1; } 50% { opacity: 0.3; } }',
-'.ripple { animation: ripple 2s infinite; }',
-'@keyframes ripple { 0% { transform: scale(1); } 50% { transform: scale(1.1); } }',
-'.splash { animation: splash 1s infinite; display: inline-block; }',
-'@keyframes splash { 0% { transform: translateY(0); } 50% { transform: translateY(-5px); } }',
-'.drift { animation: drift 3s infinite; display: inline-block; }',
-'@keyframes drift { 0% { transform: translateX(0); } 50% { transform: translateX(10px); } }',
-'.surge { animation: surge 2s infinite; }',
-'@keyframes surge { 0% { transform: scale(1); } 50% { transform: scale(1.05); } }',
-'.tide { animation: tide 4s infinite; display: inline-block; }',
-'@keyframes tide { 0% { transform: translateY(0); } 50% { transform: translateY(5px); } }',
-'.mist { background: rgba(200,200,200,0.5); animation: mist 3s infinite; }',
-'@keyframes mist { 0% { opacity: 0.5; } 50% { opacity: 0.8; } }',
-'.flame { background: linear-gradient(to top, red, orange); color: white; padding: 2px 5px; }',
-'.smoke { color: #666; animation: smoke 3s infinite; }',
-'@keyframes smoke { 0% { transform: translateY(0); opacity: 1; } 100% { transform: translateY(-10px); opacity: 0.5; } }',
-'.dust { color: #cc9966; animation: dust 2s infinite; }',
-'@keyframes dust { 0% { opacity: 1; } 50% { opacity: 0.7; } }',
-'.sand { background: #f4a460; color: white; padding: 2px 5px; }',
-'.wind { animation: wind 2s infinite; display: inline-block; }',
-'@keyframes wind { 0% { transform: translateX(0); } 50% { transform: translateX(5px); } }',
-'.storm { background: #333; color: white; animation: storm 1s infinite; }',
-'@keyframes storm { 0% { opacity: 1; } 10% { opacity: 0.8; } 20% { opacity: 1; } }',
-'.shadowdance { animation: shadowdance 2s infinite; }',
-'@keyframes shadowdance { 0% { text-shadow: 2px 2px 5px black; } 50% { text-shadow: -2px -2px 5px black; } }',
-'.lightning { animation: lightning 0.5s infinite; }',
-'@keyframes lightning { 0% { opacity: 1; } 10% { opacity: 0; } 20% { opacity: 1; } }',
-'',
-'/* Structural Elements */',
-'.alert { border: 2px solid red; padding: 10px; }',
-'.note { background: #f0f0f0; padding: 10px; }',
-'.center { text-align: center; }',
-'.right { text-align: right; }',
-'.spoiler { background: #000; color: #000; }',
-'.spoiler:hover { color: #fff; }',
-'',
-'/* Colors */',
-'.red { color: red; }',
-'.blue { color: blue; }',
-'.green { color: green; }',
-'.purple { color: purple; }',
-'</style>',
-'</head>',
-'<body>']
-
-
-        lines = markfunk_text.split('\n')
+'<title>MarkFunk Document</title>']
+        if stylesheet_href is not None:
+            head.append(f'<link rel="stylesheet" href="{escape(stylesheet_href)}">')
+        elif minify:
+            head.append(f'<style>{minify_css(stylesheet_rules(classes))}</style>')
+        else:
+            head.append('<style>')
+            head.extend(stylesheet_rules(classes))
+            head.append('</style>')
+        head.extend(self.head_extra)
+        head.extend(['</head>', '<body>'])
+        return '\n'.join(head)
+
+    def compile_body(self, lines, variables=None):
+        """Yield the HTML between <body> and </body> in chunks, streaming loops as they expand."""
+        context = self.render_context(variables)
+        yield from self.stream_body(self.parse_body(lines, structured=False, context=context), context)
+
+    def parse_body(self, lines, structured=True, variables=None, context=None):
+        """Yield the body-level IR nodes for an iterable of lines.
+
+        Without structured, lines are rendered straight away and wrapped in
+        nodes that just carry their HTML, and a code block's node carries a
+        generator of its HTML pieces, to be read before the next node.
+        """
+        context = context or self.render_context(variables)
         in_code_block = False
         code_content = []
 
         for line in lines:
+            line = line.rstrip('\n')
             if line.strip() == '```':
                 if not in_code_block:
                     in_code_block = True
                     code_content = []
                 else:
                     in_code_block = False
-                    html.append('<div class="code-block">')
-                    html.append(self.process_code_block('\n'.join(code_content)))
-                    html.append('</div>')
+                    if structured:
+                        yield (CODE, list(self.parse_code_block('\n'.join(code_content), context=context)))
+                    else:
+                        yield (CODE, self.stream_code_block('\n'.join(code_content), context))
             elif in_code_block:
                 code_content.append(line)
             else:
-                processed_line = escape(line.strip())
-                for pattern, replacement in self.patterns:
-                    processed_line = re.sub(pattern, replacement, processed_line)
-                if processed_line:
-                    html.append(processed_line)
+                node = self.parse_line(escape(line.strip()), structured)
+                if node is not None:
+                    yield node
+
+def _file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+class BuildCache:
+    """Build state kept on disk between runs for incremental rebuilds.
+
+    Remembers the content hash of each compiled source together with the page
+    it produced, plus the most recently used rendered code blocks, up to
+    max_blocks of them and max_block_bytes in all. Everything is dropped
+    when the compiler version or pattern table changes.
+    """
+    FILENAME = 'cache.json'
+
+    def __init__(self, directory, fingerprint, max_files=100000, max_blocks=4096, max_block_bytes=64 << 20):
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.files = LRUCache(max_files)
+        self.blocks = LRUCache(max_blocks, max_block_bytes)
+        try:
+            with open(os.path.join(directory, self.FILENAME), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get('fingerprint') == fingerprint:
+            self.files.update(data.get('files', {}))
+            self.blocks.update(data.get('blocks', {}))
+
+    def is_fresh(self, source, target, digest):
+        """True if target was built from a source with this digest and is untouched since."""
+        entry = self.files.get(os.path.abspath(source))
+        return entry is not None and entry == [digest, os.path.abspath(target), _file_stamp(target)]
+
+    def record(self, source, target, digest):
+        self.files.put(os.path.abspath(source), [digest, os.path.abspath(target), _file_stamp(target)])
 
-        html.extend(['</body>', '</html>'])
-        return '\n'.join(html)
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self.FILENAME)
+        data = {'fingerprint': self.fingerprint,
+                'files': dict(self.files.entries),
+                'blocks': dict(self.blocks.entries)}
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
 
 def main():
-    parser = argparse.ArgumentParser(description="Compile MarkFunk files to HTML with funky flair!")
-    parser.add_argument("filepath", help="Path to the MarkFunk file (e.g., EXAMPLE.md)")
+    use_colors()
+    if sys.argv[1:2] == ['serve']:
+        return serve(sys.argv[2:])
+    import argparse
+    parser = argparse.ArgumentParser(description="Compile MarkFunk files to HTML with funky flair!",
+                                     epilog="Run 'mfmd.py serve --help' to start a local compile server instead.")
+    parser.add_argument("filepaths", nargs="+", metavar="filepath",
+                        help="Path to the MarkFunk file (e.g., EXAMPLE.md); several files, directories or glob patterns compile in batch mode")
     parser.add_argument("--open-web", action="store_true", help="Open the compiled HTML in your default web browser")
+    parser.add_argument("-o", "--out-dir", help="Batch mode: write pages under this directory instead of next to their sources")
+    parser.add_argument("-j", "--jobs", type=int, help="Batch mode and --split-lines: number of worker processes (default: one per CPU)")
+    parser.add_argument("--split-lines", type=int, metavar="N",
+                        help="Single file: compile a large document N lines at a time on -j worker processes "
+                             "(code blocks are never split; the page is the same as without it)")
+    parser.add_argument("--cache", action="store_true", help="Skip files that haven't changed since the last cached build")
+    parser.add_argument("--cache-dir", default=".markfunk-cache", help="Where --cache keeps its state (default: .markfunk-cache)")
+    parser.add_argument("--watch", action="store_true", help="Keep running and recompile inputs whenever they change")
+    parser.add_argument("--interval", type=float, default=0.1, help="Watch mode: seconds between checks for changes (default: 0.1)")
+    parser.add_argument("--serve", action="store_true", help="Watch mode: serve the pages locally and reload the browser after each rebuild")
+    parser.add_argument("--port", type=int, default=8000, help="Port for --serve (default: 8000)")
+    parser.add_argument("--css", choices=("inline", "external"), default="inline",
+                        help="Inline the stylesheet in every page, or write it once to markfunk.<hash>.css and link it (default: inline)")
+    parser.add_argument("--css-purge", action="store_true", help="Only emit the CSS rules for classes each page actually uses")
+    parser.add_argument("--minify", action="store_true",
+                        help="Collapse whitespace in the HTML and CSS; <pre> and <code> contents are kept as written")
+    parser.add_argument("--precompress", action="store_true",
+                        help="Also write each page gzip-compressed to .html.gz, and to .html.br if brotli is installed")
+    parser.add_argument("--emit-ir", action="store_true",
+                        help=f"Write parsed, precompiled {PRECOMPILED_EXTENSION} files instead of HTML; pass those back in to render them without parsing")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time every pattern, loop and code block and print the slowest (batch mode then runs in one process)")
+    parser.add_argument("--profile-json", metavar="PATH", help="Also write the full --profile trace to PATH as JSON (implies --profile)")
+    parser.add_argument("--profile-top", type=int, default=10, help="Entries per table in the --profile report (default: 10)")
+    parser.add_argument("--var", action="append", default=[], type=variable_argument, metavar="NAME=VALUE",
+                        help="Default for {NAME} in every code block, unless the block sets it with @var{} (repeatable)")
     args = parser.parse_args()
+    if args.split_lines is not None and args.split_lines < 1:
+        parser.error("--split-lines must be at least 1")
 
+    options = {'stylesheet_dir': (args.out_dir or '.') if args.css == 'external' else None,
+               'purge_css': args.css_purge,
+               'emit_ir': args.emit_ir,
+               'minify': args.minify,
+               'precompress': args.precompress}
+
+    profiler = Profiler() if args.profile or args.profile_json else None
+    variables = dict(args.var)
+
+    single = len(args.filepaths) == 1 and args.out_dir is None and not is_batch_input(args.filepaths[0])
+    if args.watch:
+        status = watch(args.filepaths, args.out_dir, single, args.interval,
+                       args.port if args.serve else None, args.open_web, options, profiler, variables)
+        return report_profile(profiler, args.profile_json, args.profile_top) or status
+
+    fingerprint = MarkFunkCompiler(variables=variables).fingerprint(sorted(options.items()))
+    cache = BuildCache(args.cache_dir, fingerprint) if args.cache else None
+    if single:
+        output_file = compile_single(args.filepaths[0], cache, options, profiler, variables, args.jobs, args.split_lines)
+        failed = output_file is None
+    else:
+        outputs, failed = compile_batch(args.filepaths, args.out_dir, args.jobs, cache, options, profiler, variables)
+        output_file = outputs[0] if outputs else None
+    report_profile(profiler, args.profile_json, args.profile_top)
+
+    # Open in web browser if --open-web is specified
+    if args.open_web and output_file and not args.emit_ir:
+        open_in_browser(output_file)
+    return 1 if failed else 0
+
+def variable_argument(text):
+    """Parse a --var NAME=VALUE argument into a (name, value) pair."""
+    import argparse
+    name, equals, value = text.partition('=')
+    if not equals or not name:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got '{text}'")
+    return name, value
+
+def report_profile(profiler, json_path=None, top=10):
+    """Print a --profile report and write its JSON trace; returns 1 if the trace can't be written."""
+    if profiler is None:
+        return 0
+    print(f"{Fore.YELLOW}Profile:{Style.RESET_ALL} slowest patterns, loops and code blocks (times include nested work)")
+    print(profiler.report(top))
+    if json_path:
+        try:
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(profiler.trace(), f, indent=2)
+        except OSError as e:
+            print(f"{Fore.RED}✘ Bummer!{Style.RESET_ALL} Couldn't write the profile to '{json_path}': {str(e)}")
+            return 1
+        print(f"{Fore.GREEN}✔ Saved!{Style.RESET_ALL} Full profile trace written to '{json_path}'.")
+    return 0
+
+def compile_single(filepath, cache=None, options=None, profiler=None, variables=None, jobs=None, split_lines=None):
+    """Compile one file to output.html; returns the output path, or None on failure.
+
+    options are the compile_file() keyword arguments for the page; a
+    profiler, if given, collects timings for the compile, and variables are
+    the document-wide defaults for code blocks. With split_lines, the file is
+    compiled that many lines at a time on jobs worker processes, unless it
+    is being profiled.
+    """
     # Check if file exists
-    if not os.path.isfile(args.filepath):
-        print(f"{Fore.RED}✘ Oops!{Style.RESET_ALL} The file '{args.filepath}' doesn't exist. Did you mistype the name or path?")
+    if not os.path.isfile(filepath):
+        print(f"{Fore.RED}✘ Oops!{Style.RESET_ALL} The file '{filepath}' doesn't exist. Did you mistype the name or path?")
         print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Make sure the file is in the right directory and try again!")
-        return
+        return None
 
-    # Read the MarkFunk file
+    options = options or {}
+    if options.get('emit_ir') and filepath.endswith(PRECOMPILED_EXTENSION):
+        print(f"{Fore.RED}✘ Oops!{Style.RESET_ALL} '{filepath}' is already precompiled.")
+        print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Drop --emit-ir to render it to HTML.")
+        return None
+    output_file = output_name('output', options)
+    if cache is not None:
+        digest = file_digest(filepath)
+        if cache.is_fresh(filepath, output_file, digest):
+            print(f"{Fore.GREEN}✔ Up to date!{Style.RESET_ALL} '{filepath}' hasn't changed since '{output_file}' was built.")
+            return output_file
+
+    # Compile the MarkFunk file straight into the output file, line by line
+    compiler = MarkFunkCompiler(variables=variables)
+    if cache is not None:
+        compiler.block_cache.update(cache.blocks.entries)
+        compiler.block_cache.track_new = True
+    if profiler is not None:
+        compiler.enable_profiling(profiler)
     try:
-        with open(args.filepath, 'r', encoding='utf-8') as f:
-            markfunk_text = f.read()
+        source = open_source(filepath)
     except FileNotFoundError:  # This shouldn't happen due to prior check, but included for completeness
-        print(f"{Fore.RED}✘ Yikes!{Style.RESET_ALL} Couldn't find '{args.filepath}'. It vanished!")
-        return
+        print(f"{Fore.RED}✘ Yikes!{Style.RESET_ALL} Couldn't find '{filepath}'. It vanished!")
+        return None
     except PermissionError:
-        print(f"{Fore.RED}✘ Uh-oh!{Style.RESET_ALL} No permission to read '{args.filepath}'. Check your file permissions.")
-        return
+        print(f"{Fore.RED}✘ Uh-oh!{Style.RESET_ALL} No permission to read '{filepath}'. Check your file permissions.")
+        return None
     except Exception as e:
-        print(f"{Fore.RED}✘ Something went wrong!{Style.RESET_ALL} Error reading '{args.filepath}': {str(e)}")
+        print(f"{Fore.RED}✘ Something went wrong!{Style.RESET_ALL} Error reading '{filepath}': {str(e)}")
         print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Ensure the file is readable and not corrupted.")
+        return None
+
+    executor = None
+    if split_lines and profiler is None and not options.get('emit_ir') and 'b' not in source.mode:
+        from concurrent.futures import ProcessPoolExecutor
+        blocks = dict(cache.blocks.entries) if cache is not None else None
+        executor = ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1, initializer=_init_worker,
+                                       initargs=(blocks, None, variables))
+
+    with source:
+        try:
+            with open_target(output_file) as f:
+                write_page(compiler, source, f, output_file, executor=executor, split_lines=split_lines, **options)
+            print(f"{Fore.GREEN}✔ Success!{Style.RESET_ALL} Your MarkFunk file has been compiled to '{output_file}'.")
+        except (UnicodeDecodeError, ValueError) as e:
+            print(f"{Fore.RED}✘ Something went wrong!{Style.RESET_ALL} Error reading '{filepath}': {str(e)}")
+            print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Ensure the file is readable and not corrupted.")
+            return None
+        except PermissionError:
+            print(f"{Fore.RED}✘ Oh no!{Style.RESET_ALL} Can't write to '{output_file}'. Check your write permissions!")
+            return None
+        except Exception as e:
+            print(f"{Fore.RED}✘ Bummer!{Style.RESET_ALL} Failed to write '{output_file}': {str(e)}")
+            print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Ensure you have space and write access in this directory.")
+            return None
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    if cache is not None:
+        cache.record(filepath, output_file, digest)
+        cache.blocks.update(compiler.block_cache.take_new())
+        cache.save()
+    return output_file
+
+def is_batch_input(path):
+    return os.path.isdir(path) or any(char in path for char in '*?[')
+
+def _glob_base(pattern):
+    """Return the leading directories of a glob pattern that hold no wildcards."""
+    parts = []
+    for part in os.path.dirname(pattern).split(os.sep):
+        if any(char in part for char in '*?['):
+            break
+        parts.append(part)
+    return os.sep.join(parts)
+
+def collect_inputs(paths, out_dir=None, suffix='.html'):
+    """Expand files, directories and glob patterns into (source, target) pairs.
+
+    Pages are written next to their sources, or under out_dir when given;
+    files found in a directory or by a glob keep their layout relative to
+    it (or to the glob's leading directories). Glob matches must be
+    MarkFunk or precompiled files, and a source that would be its own
+    target is skipped. Raises ValueError if two sources would be written
+    to the same target.
+    """
+    import glob
+    jobs = []
+    targets = {}
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                found.extend(os.path.join(root, name) for name in sorted(files)
+                             if name.endswith(MARKFUNK_EXTENSIONS))
+            base = path
+        elif is_batch_input(path):
+            found = sorted(match for match in glob.glob(path, recursive=True)
+                           if os.path.isfile(match) and match.endswith(MARKFUNK_EXTENSIONS + (PRECOMPILED_EXTENSION,)))
+            base = _glob_base(path) or '.'
+        else:
+            found = [path]
+            base = None
+        for source in found:
+            relative = os.path.relpath(source, base) if base else os.path.basename(source)
+            stem = os.path.splitext(source if out_dir is None else os.path.join(out_dir, relative))[0]
+            target = stem + suffix
+            same = os.path.normcase(os.path.abspath(source))
+            key = os.path.normcase(os.path.abspath(target))
+            if key == same:
+                continue
+            if key in targets:
+                if targets[key][0] == same:
+                    continue  # the same file named twice
+                raise ValueError(f"'{targets[key][1]}' and '{source}' would both be compiled to '{target}'")
+            targets[key] = (same, source)
+            jobs.append((source, target))
+    return jobs
+
+# One compiler per batch worker process, created by _init_worker
+_worker_compiler = None
+_worker_options = {}
+
+def _init_worker(blocks=None, options=None, variables=None, limits=None):
+    """Set up a batch worker, optionally sharing a build cache's code blocks.
+
+    With blocks, the worker's block cache starts from them and the blocks
+    it renders are handed back by _compile_job(). limits are
+    MarkFunkCompiler keyword arguments such as max_iterations.
+    """
+    global _worker_compiler, _worker_options
+    _worker_compiler = MarkFunkCompiler(variables=variables, **(limits or {}))
+    _worker_options = options or {}
+    if blocks is not None:
+        _worker_compiler.block_cache.update(blocks)
+        _worker_compiler.block_cache.track_new = True
+
+def output_name(stem, options):
+    return stem + (PRECOMPILED_EXTENSION if options.get('emit_ir') else '.html')
+
+def open_source(path):
+    """Open a MarkFunk source as text, or a precompiled document as bytes."""
+    if path.endswith(PRECOMPILED_EXTENSION):
+        return open(path, 'rb')
+    return open(path, 'r', encoding='utf-8')
+
+def open_target(path):
+    if path.endswith(PRECOMPILED_EXTENSION):
+        return open(path, 'wb')
+    return open(path, 'w', encoding='utf-8')
+
+def write_page(compiler, source, dst, target, stylesheet_dir=None, purge_css=False, emit_ir=False,
+               minify=False, precompress=False, executor=None, split_lines=None):
+    """Write the output for a source opened with open_source() to dst.
+
+    With emit_ir the parsed document is written instead of HTML. With a
+    stylesheet_dir, the stylesheet is written there once and linked from
+    target instead of being inlined. minify collapses the page's whitespace,
+    and precompress also writes compressed copies of it next to target.
+    With an executor and split_lines, a MarkFunk source is compiled
+    split_lines lines at a time on the executor (see compile_body_parallel).
+    """
+    precompiled = 'b' in source.mode
+    if emit_ir:
+        if precompiled:
+            raise ValueError('already precompiled')
+        compiler.dump(compiler.parse(source), dst)
         return
+    link = partial(link_stylesheet, stylesheet_dir, target, minify=minify) if stylesheet_dir is not None else None
+    if precompress:
+        dst = PrecompressingWriter(dst, target)
+    try:
+        if precompiled:
+            compiler.render_stream(compiler.load(source), dst, purge_css, link, minify)
+        elif executor is not None and split_lines:
+            body = compile_body_parallel(source, executor, split_lines, block_cache=compiler.block_cache)
+            compiler.write_document(body, dst, purge_css, link, minify)
+        else:
+            compiler.compile_stream(source, dst, purge_css, link, minify=minify)
+    finally:
+        if precompress:
+            dst.close()
+
+class PrecompressingWriter:
+    """Passes a page on to writable while streaming it into target.gz and target.br.
 
-    # Compile the MarkFunk
-    compiler = MarkFunkCompiler()
-    html_output = compiler.compile(markfunk_text)
+    The brotli copy is only written when the brotli module is installed.
+    """
+    def __init__(self, writable, target):
+        import gzip
+        self.writable = writable
+        # mtime=0 keeps the .gz bytes the same from build to build
+        self.copies = [gzip.GzipFile(target + '.gz', 'wb', compresslevel=9, mtime=0)]
+        try:
+            import brotli
+        except ImportError:
+            return
+        self.copies.append(_BrotliFile(target + '.br', brotli.Compressor(quality=11)))
+
+    def write(self, text):
+        self.writable.write(text)
+        data = text.encode('utf-8')
+        for copy in self.copies:
+            copy.write(data)
+        return len(text)
+
+    def close(self):
+        """Finish the compressed copies; the page itself is left open."""
+        for copy in self.copies:
+            copy.close()
+
+class _BrotliFile:
+    """Write-only binary file that brotli-compresses what is written to it."""
+    def __init__(self, path, compressor):
+        self.file = open(path, 'wb')
+        self.compressor = compressor
+
+    def write(self, data):
+        self.file.write(self.compressor.process(data))
 
-    # Write to output file
-    output_file = 'output.html'
+    def close(self):
+        with self.file:
+            self.file.write(self.compressor.finish())
+
+def compile_file(compiler, source, target, **options):
+    """Compile source into target; returns an error message or None."""
+    if options.get('emit_ir') and source.endswith(PRECOMPILED_EXTENSION):
+        # Checked before open_target(), which would truncate a source that is also the target
+        return 'already precompiled'
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(html_output)
-        print(f"{Fore.GREEN}✔ Success!{Style.RESET_ALL} Your MarkFunk file has been compiled to '{output_file}'.")
-    except PermissionError:
-        print(f"{Fore.RED}✘ Oh no!{Style.RESET_ALL} Can't write to '{output_file}'. Check your write permissions!")
-        return
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        with open_source(source) as src, open_target(target) as dst:
+            write_page(compiler, src, dst, target, **options)
     except Exception as e:
-        print(f"{Fore.RED}✘ Bummer!{Style.RESET_ALL} Failed to write '{output_file}': {str(e)}")
-        print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Ensure you have space and write access in this directory.")
-        return
+        return str(e)
+    return None
 
-    # Open in web browser if --open-web is specified
-    if args.open_web:
+def _compile_job(source, target):
+    """Compile source into target in a batch worker.
+
+    Returns (error message or None, code blocks rendered for the build cache).
+    """
+    error = compile_file(_worker_compiler, source, target, **_worker_options)
+    if error is not None:
+        return error, {}
+    return None, _worker_compiler.block_cache.take_new()
+
+def split_document(lines, chunk_lines):
+    """Group lines into lists of at least chunk_lines lines that compile independently.
+
+    A chunk only ends outside a fenced code block, so every block is kept whole.
+    """
+    chunk = []
+    in_code_block = False
+    for line in lines:
+        chunk.append(line)
+        if line.strip() == '```':
+            in_code_block = not in_code_block
+        if len(chunk) >= chunk_lines and not in_code_block:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _compile_chunk(lines):
+    """Compile one split_document() chunk in a worker.
+
+    Returns (body HTML, code blocks rendered for the build cache).
+    """
+    html = ''.join(_worker_compiler.compile_body(lines))
+    return html, _worker_compiler.block_cache.take_new()
+
+def compile_body_parallel(lines, executor, chunk_lines, ahead=None, block_cache=None):
+    """Yield the same HTML as compile_body(lines), compiled in chunks on executor.
+
+    The executor's workers must have been set up by _init_worker(). At most
+    ahead chunks (default: four per CPU) are read and compiling at once, so
+    memory stays bounded however long the document is. Code blocks the
+    workers render for a build cache are put() into block_cache, if given.
+    """
+    ahead = ahead or 4 * (os.cpu_count() or 1)
+    pending = deque()
+    def result():
+        html, blocks = pending.popleft().result()
+        if block_cache is not None:
+            for key, value in blocks.items():
+                block_cache.put(key, value)
+        return html
+    for chunk in split_document(lines, chunk_lines):
+        if len(pending) >= ahead:
+            yield result()
+        pending.append(executor.submit(_compile_chunk, chunk))
+    while pending:
+        yield result()
+
+def compile_batch(paths, out_dir=None, jobs=None, cache=None, options=None, profiler=None, variables=None):
+    """Compile many pages across a process pool; returns (outputs, failures).
+
+    With a BuildCache, sources whose content hash matches the last build are
+    skipped and the cache is updated and saved afterwards. With a profiler
+    the pages are compiled in this process so it can time them.
+    """
+    try:
+        work = collect_inputs(paths, out_dir, output_name('', options or {}))
+    except ValueError as e:
+        print(f"{Fore.RED}✘ Oops!{Style.RESET_ALL} {str(e)}.")
+        print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Rename one of them, or compile them into different --out-dir directories.")
+        return [], [(path, str(e)) for path in paths]
+    if not work:
+        print(f"{Fore.RED}✘ Oops!{Style.RESET_ALL} No MarkFunk files found in {', '.join(paths)}.")
+        print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Batch mode looks for {' and '.join(MARKFUNK_EXTENSIONS)} files in directories.")
+        return [], [(path, 'no input files') for path in paths]
+
+    started = time.perf_counter()
+    up_to_date = []
+    digests = {}
+    if cache is not None:
+        pending = []
+        for source, target in work:
+            try:
+                digests[source] = file_digest(source)
+            except OSError:
+                pending.append((source, target))
+                continue
+            if cache.is_fresh(source, target, digests[source]):
+                up_to_date.append(target)
+            else:
+                pending.append((source, target))
+        work_to_do = pending
+    else:
+        work_to_do = work
+
+    sources = [source for source, _ in work_to_do]
+    targets = [target for _, target in work_to_do]
+    blocks = dict(cache.blocks.entries) if cache is not None else None
+    if jobs == 1 or len(work_to_do) <= 1 or profiler is not None:
+        _init_worker(blocks, options, variables)
+        if profiler is not None:
+            _worker_compiler.enable_profiling(profiler)
+        results = list(map(_compile_job, sources, targets))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        workers = jobs or os.cpu_count() or 1
+        chunksize = max(1, len(work_to_do) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(blocks, options, variables)) as executor:
+            results = list(executor.map(_compile_job, sources, targets, chunksize=chunksize))
+    elapsed = time.perf_counter() - started
+
+    outputs = up_to_date + [target for target, (error, _) in zip(targets, results) if error is None]
+    failures = [(source, error) for source, (error, _) in zip(sources, results) if error is not None]
+    if cache is not None:
+        for source, target, (error, new_blocks) in zip(sources, targets, results):
+            if error is None and source in digests:
+                cache.record(source, target, digests[source])
+            cache.blocks.update(new_blocks)
+        cache.save()
+
+    for source, error in failures:
+        print(f"{Fore.RED}✘ Failed:{Style.RESET_ALL} '{source}': {error}")
+    rate = len(work_to_do) / elapsed if elapsed else float('inf')
+    color = Fore.GREEN if not failures else Fore.YELLOW
+    print(f"{color}✔ Done!{Style.RESET_ALL} Compiled {len(outputs) - len(up_to_date)} of {len(work)} files in {elapsed:.2f}s "
+          f"({rate:.1f} files/sec, {len(up_to_date)} up to date, {len(failures)} failed).")
+    return outputs, failures
+
+# Injected into pages built by --watch --serve; long-polls the server and
+# reloads as soon as a rebuild finishes
+LIVE_RELOAD_SCRIPT = """<script>
+(function () {
+  var build = -1;
+  function poll() {
+    fetch('/__markfunk__/wait?build=' + build, {cache: 'no-store'})
+      .then(function (response) { return response.text(); })
+      .then(function (text) {
+        if (build >= 0 && +text !== build) { location.reload(); return; }
+        build = +text;
+        poll();
+      })
+      .catch(function () { setTimeout(poll, 1000); });
+  }
+  poll();
+})();
+</script>"""
+
+class LiveReload:
+    """Build counter that browsers can wait on through the preview server."""
+    def __init__(self):
+        self.build = 0
+        self.changed = threading.Condition()
+
+    def bump(self):
+        with self.changed:
+            self.build += 1
+            self.changed.notify_all()
+
+    def wait(self, seen, timeout=25):
+        with self.changed:
+            self.changed.wait_for(lambda: self.build != seen, timeout)
+            return self.build
+
+def serve_directory(directory, port, reload):
+    """Serve directory on localhost in a background thread, answering live reload polls."""
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/__markfunk__/wait':
+                return super().do_GET()
+            try:
+                seen = int(parse_qs(url.query).get('build', ['-1'])[0])
+            except ValueError:
+                seen = -1
+            body = str(reload.wait(seen)).encode('ascii')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), partial(Handler, directory=directory))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def watch(paths, out_dir=None, single=False, interval=0.1, port=None, open_web=False, options=None, profiler=None,
+          variables=None):
+    """Recompile inputs as they change, reusing one warm compiler.
+
+    With a port, the output directory is served on localhost and every page
+    gets LIVE_RELOAD_SCRIPT so open browsers refresh after each rebuild.
+    """
+    compiler = MarkFunkCompiler(variables=variables)
+    if profiler is not None:
+        compiler.enable_profiling(profiler)
+    reload = None
+    if port is not None:
+        reload = LiveReload()
+        root = out_dir or '.'
+        os.makedirs(root, exist_ok=True)
         try:
-            webbrowser.open(f'file://{os.path.abspath(output_file)}')
-            print(f"{Fore.GREEN}✔ Cool!{Style.RESET_ALL} Opened '{output_file}' in your default web browser.")
-        except Exception as e:
-            print(f"{Fore.RED}✘ Darn!{Style.RESET_ALL} Couldn't open the browser: {str(e)}")
-            print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} You can manually open '{output_file}' in your browser.")
+            server = serve_directory(root, port, reload)
+        except OSError as e:
+            print(f"{Fore.RED}✘ Darn!{Style.RESET_ALL} Couldn't start the preview server on port {port}: {str(e)}")
+            print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Pick another one with --port.")
+            return 1
+        compiler.head_extra = [LIVE_RELOAD_SCRIPT]
+        print(f"{Fore.GREEN}✔ Serving!{Style.RESET_ALL} Preview at http://127.0.0.1:{port}/")
+
+    print(f"{Fore.YELLOW}Watching{Style.RESET_ALL} {', '.join(paths)} for changes. Press Ctrl+C to stop.")
+    stamps = {}
+    first = True
+    clash = None
+    try:
+        while True:
+            try:
+                work = ([(paths[0], output_name('output', options or {}))] if single
+                        else collect_inputs(paths, out_dir, output_name('', options or {})))
+                clash = None
+            except ValueError as e:
+                # Wait for the inputs to be renamed; only say so once
+                if str(e) != clash:
+                    print(f"{Fore.RED}✘ Failed:{Style.RESET_ALL} {str(e)}")
+                clash = str(e)
+                work = []
+            rebuilt = []
+            for source, target in work:
+                stamp = _file_stamp(source)
+                if stamp is None or stamps.get(source) == stamp:
+                    continue
+                stamps[source] = stamp
+                started = time.perf_counter()
+                error = compile_file(compiler, source, target, **(options or {}))
+                elapsed = (time.perf_counter() - started) * 1000
+                if error is None:
+                    rebuilt.append(target)
+                    print(f"{Fore.GREEN}✔ Rebuilt{Style.RESET_ALL} '{target}' in {elapsed:.1f}ms")
+                else:
+                    print(f"{Fore.RED}✘ Failed:{Style.RESET_ALL} '{source}': {error}")
+            if rebuilt and reload is not None:
+                reload.bump()
+            if first and rebuilt and open_web:
+                if reload is None:
+                    open_in_browser(rebuilt[0])
+                else:
+                    page = os.path.relpath(rebuilt[0], out_dir or '.').replace(os.sep, '/')
+                    open_in_browser(rebuilt[0], f'http://127.0.0.1:{port}/{page}')
+            first = False
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print(f"{Fore.GREEN}✔ Bye!{Style.RESET_ALL} Stopped watching.")
+    if port is not None:
+        server.shutdown()
+    return 0
+
+def open_in_browser(output_file, url=None):
+    import webbrowser
+    try:
+        webbrowser.open(url or f'file://{os.path.abspath(output_file)}')
+        print(f"{Fore.GREEN}✔ Cool!{Style.RESET_ALL} Opened '{output_file}' in your default web browser.")
+    except Exception as e:
+        print(f"{Fore.RED}✘ Darn!{Style.RESET_ALL} Couldn't open the browser: {str(e)}")
+        print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} You can manually open '{output_file}' in your browser.")
+
+# Largest request body the compile server accepts
+MAX_REQUEST_BYTES = 32 << 20
+
+def _compile_text(text, purge_css=False, variables=None, minify=False):
+    """Compile a MarkFunk document to a full HTML page in a server worker."""
+    page = io.StringIO()
+    _worker_compiler.compile_stream(text.split('\n'), page, purge_css, variables=variables, minify=minify)
+    return page.getvalue()
+
+def _init_server_worker(variables=None, limits=None):
+    import signal
+    # Ctrl+C is handled by the server process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(variables=variables, limits=limits)
+
+class ServerStats:
+    """Request, document and latency counters for the compile server."""
+    def __init__(self, samples=1000):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.documents = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.busy = 0.0
+        self.latencies = deque(maxlen=samples)
+
+    def record(self, documents, seconds, bytes_in, bytes_out, error=False):
+        with self.lock:
+            self.requests += 1
+            self.documents += documents
+            self.errors += error
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.busy += seconds
+            self.latencies.append(seconds)
+
+    def snapshot(self):
+        """Return the counters as JSON-serializable data; latencies are over recent requests, in ms."""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            uptime = time.time() - self.started
+            data = {'uptime_seconds': uptime, 'requests': self.requests, 'documents': self.documents,
+                    'errors': self.errors, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                    'documents_per_second': self.documents / uptime if uptime else 0.0,
+                    'documents_per_busy_second': self.documents / self.busy if self.busy else 0.0}
+        if latencies:
+            pick = lambda fraction: latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000
+            data['latency_ms'] = {'mean': sum(latencies) / len(latencies) * 1000, 'p50': pick(0.5),
+                                  'p95': pick(0.95), 'p99': pick(0.99), 'max': latencies[-1] * 1000}
+        return data
+
+def serve_compiler(address, executor, stats):
+    """Start the compile server on a (host, port) pair or a Unix socket path.
+
+    POST /compile takes {"text": "..."} and answers with the HTML page, or
+    {"documents": ["...", ...]} and answers with {"html": [...]}. Optional
+    "purge_css", "minify" and "variables" (defaults for {name} in code
+    blocks) apply to every document in the request. GET /stats returns the
+    ServerStats counters. Compiles run on executor, whose workers were set
+    up by _init_worker().
+    """
+    import socket
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class UnixHTTPServer(ThreadingHTTPServer):
+        """ThreadingHTTPServer listening on a Unix domain socket."""
+        address_family = socket.AF_UNIX
+
+        def server_bind(self):
+            socketserver.TCPServer.server_bind(self)
+            self.server_name = 'localhost'
+            self.server_port = 0
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/stats':
+                self.reply(200, 'application/json', json.dumps(stats.snapshot()).encode('utf-8'))
+            elif self.path == '/health':
+                self.reply(200, 'text/plain', b'ok')
+            else:
+                self.reply(404, 'application/json', b'{"error": "not found"}')
+
+        def do_POST(self):
+            started = time.perf_counter()
+            status, kind, body, documents, length = self.compile()
+            self.reply(status, kind, body)
+            stats.record(documents, time.perf_counter() - started, length, len(body), status != 200)
+
+        def compile(self):
+            """Handle a /compile request; returns (status, content type, body, document count, bytes read)."""
+            if self.path != '/compile':
+                return 404, 'application/json', b'{"error": "not found"}', 0, 0
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+            except ValueError:
+                length = -1
+            if not 0 < length <= MAX_REQUEST_BYTES:
+                return 413 if length > 0 else 411, 'application/json', b'{"error": "bad Content-Length"}', 0, 0
+            try:
+                request = json.loads(self.rfile.read(length))
+                purge_css = bool(request.get('purge_css', False))
+                minify = bool(request.get('minify', False))
+                variables = request.get('variables') or {}
+                if not isinstance(variables, dict):
+                    raise TypeError('variables must be an object')
+                batch = 'documents' in request
+                documents = request['documents'] if batch else [request['text']]
+                if not all(isinstance(text, str) for text in documents):
+                    raise TypeError('documents must be strings')
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                error = {'error': f'expected {{"text": "..."}} or {{"documents": [...]}}: {e}'}
+                return 400, 'application/json', json.dumps(error).encode('utf-8'), 0, length
+            try:
+                if batch:
+                    pages = list(executor.map(partial(_compile_text, purge_css=purge_css, variables=variables,
+                                                      minify=minify), documents))
+                else:
+                    pages = [executor.submit(_compile_text, documents[0], purge_css, variables, minify).result()]
+            except Exception as e:
+                return 500, 'application/json', json.dumps({'error': str(e)}).encode('utf-8'), len(documents), length
+            if batch:
+                return 200, 'application/json', json.dumps({'html': pages}).encode('utf-8'), len(documents), length
+            return 200, 'text/html; charset=utf-8', pages[0].encode('utf-8'), 1, length
+
+        def reply(self, status, kind, body):
+            self.send_response(status)
+            self.send_header('Content-Type', kind)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.unlink(address)
+        server = UnixHTTPServer(address, Handler)
+    else:
+        server = ThreadingHTTPServer(address, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def serve(argv=None):
+    """Entry point for `mfmd.py serve`: keep warm compilers behind a local HTTP server."""
+    import argparse
+    import socket
+    from concurrent.futures import ProcessPoolExecutor
+    parser = argparse.ArgumentParser(prog="mfmd.py serve",
+                                     description="Run a local MarkFunk compile server with warm compilers")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765)")
+    parser.add_argument("--socket", metavar="PATH", help="Listen on this Unix socket instead of a TCP port")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of compiler worker processes (default: one per CPU)")
+    parser.add_argument("--var", action="append", default=[], type=variable_argument, metavar="NAME=VALUE",
+                        help="Default for {NAME} in every code block, unless the block sets it with @var{} (repeatable)")
+    parser.add_argument("--max-iterations", type=int, metavar="N",
+                        help="Render loops that would run more than N times as an error instead")
+    parser.add_argument("--max-output-bytes", type=int, metavar="N",
+                        help="End a page's body with an error once it would grow past N bytes")
+    parser.add_argument("--time-limit", type=float, metavar="SECONDS",
+                        help="End a page's body with an error once compiling it takes longer than SECONDS")
+    args = parser.parse_args(argv)
+
+    if args.socket and not hasattr(socket, 'AF_UNIX'):
+        print(f"{Fore.RED}✘ Oops!{Style.RESET_ALL} Unix sockets aren't available on this platform.")
+        print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Use --host and --port instead.")
+        return 1
+    workers = args.jobs or os.cpu_count() or 1
+    stats = ServerStats()
+    limits = {'max_iterations': args.max_iterations, 'max_output_bytes': args.max_output_bytes,
+              'time_limit': args.time_limit}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_server_worker,
+                             initargs=(dict(args.var), limits)) as executor:
+        # Start every worker and build its compiler before the first request arrives
+        list(executor.map(_compile_text, [''] * workers))
+        address = args.socket or (args.host, args.port)
+        try:
+            server = serve_compiler(address, executor, stats)
+        except OSError as e:
+            print(f"{Fore.RED}✘ Darn!{Style.RESET_ALL} Couldn't start the compile server: {str(e)}")
+            print(f"{Fore.YELLOW}Tip:{Style.RESET_ALL} Pick another one with --port or --socket.")
+            return 1
+        where = args.socket or f"http://{args.host}:{args.port}/"
+        print(f"{Fore.GREEN}✔ Serving!{Style.RESET_ALL} Compiling on {where} with {workers} worker(s). Press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+            server.server_close()
+            if args.socket:
+                os.unlink(args.socket)
+    snapshot = stats.snapshot()
+    print(f"{Fore.GREEN}✔ Bye!{Style.RESET_ALL} Served {snapshot['documents']} document(s) "
+          f"in {snapshot['requests']} request(s).")
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())